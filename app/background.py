@@ -0,0 +1,57 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Work started by a handler that the user doesn't need to wait for (e.g. flushing a collection).
+The tasks are grouped by key (usually the room id), so that the next handlers of the room can
+wait for them when they depend on their result.
+"""
+
+import asyncio
+from collections import defaultdict
+from functools import partial
+from typing import Coroutine
+
+from matrix_bot.config import logger
+from matrix_bot.metrics import metrics
+from matrix_bot.tracing import start_detached_trace
+
+_tasks: dict[str, set[asyncio.Task]] = defaultdict(set)
+
+
+def spawn(key: str, coro: Coroutine, name: str = "background") -> asyncio.Task:
+    """Run `coro` without awaiting it, its errors are logged"""
+    task = asyncio.create_task(_run_traced(coro, name, key), name=name)
+    _tasks[key].add(task)
+    task.add_done_callback(partial(_forget, key))
+    metrics.gauge("background_tasks", "Background tasks in progress").inc()
+    return task
+
+
+async def _run_traced(coro: Coroutine, name: str, key: str):
+    # In a trace of its own: the trace of the handler is likely finished before the task
+    with start_detached_trace(name, key=key):
+        return await coro
+
+
+def _forget(key: str, task: asyncio.Task) -> None:
+    _tasks[key].discard(task)
+    if not _tasks[key]:
+        del _tasks[key]
+    metrics.gauge("background_tasks").dec()
+    if not task.cancelled() and task.exception():
+        metrics.counter("background_task_errors_total", "Failed background tasks").inc()
+        logger.error(
+            "Background task failed", task=task.get_name(), key=key, error=str(task.exception())
+        )
+
+
+def is_pending(key: str) -> bool:
+    return bool(_tasks.get(key))
+
+
+async def wait(key: str) -> None:
+    """Wait for the background tasks of `key`, whether they succeed or not"""
+    while _tasks.get(key):
+        await asyncio.gather(*_tasks[key], return_exceptions=True)
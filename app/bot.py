@@ -6,25 +6,21 @@
 import time
 
 from matrix_bot.bot import MatrixBot
-from matrix_bot.config import logger
+from matrix_bot.callbacks import Callbacks
+from matrix_bot.config import bot_lib_config, logger
 
-from commands import command_registry
+from commands import command_registry, summarise_missed_messages
 from config import env_config
+from reaper import reap_stale_collections
 
 # TODO/IMPROVE:
 # - if albert-bot is invited in a salon, make it answer only when if it is tagged.
 # - !models: show available models.
-# - show sources of a mesage for some given reactions of an answer.
 # - !info: show the chat setting (model, with_history).
 
 
-def main():
-    tchap_bot = MatrixBot(
-        env_config.matrix_home_server,
-        env_config.matrix_bot_username,
-        env_config.matrix_bot_password,
-    )
-
+def register_features(callbacks: Callbacks):
+    """Register the bot features, in the main process or in each shard worker"""
     for feature in [
         feature
         for feature_group in env_config.groups_used
@@ -32,9 +28,26 @@ def main():
     ]:
         callback = feature["func"]
         onEvent = feature["onEvent"]
-        tchap_bot.callbacks.register_on_custom_event(callback, onEvent, feature)
+        callbacks.register_on_custom_event(callback, onEvent, feature)
         logger.info("loaded feature", feature=feature["name"])
 
+    callbacks.register_on_catch_up(summarise_missed_messages)
+
+
+def main():
+    tchap_bot = MatrixBot(
+        env_config.matrix_home_server,
+        env_config.matrix_bot_username,
+        env_config.matrix_bot_password,
+    )
+    register_features(tchap_bot.callbacks)
+    if bot_lib_config.shard_workers:
+        tchap_bot.use_shard_workers("bot:register_features")
+    if env_config.albert_reaper_interval:
+        tchap_bot.callbacks.register_periodic(
+            reap_stale_collections, env_config.albert_reaper_interval
+        )
+
     # To send message if Albert is updated for example...
     # async def startup_action(room_id):
     #    await tchap_bot.matrix_client.send_markdown_message(room_id, command_registry.get_help())
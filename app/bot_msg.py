@@ -1,4 +1,4 @@
-from config import APP_VERSION, COMMAND_PREFIX, Config
+from config import APP_VERSION, COMMAND_PREFIX, SOURCES_REACTION, Config
 
 
 class AlbertMsg:
@@ -9,6 +9,7 @@ class AlbertMsg:
         "\u26a0\ufe0f **Commande inconnue**",
         "**La conversation a été remise à zéro**",
         "🤖 Albert a échoué",
+        "🤖 Albert est momentanément indisponible",
     ]
     shorts = {
         "help": f"Pour retrouver ce message informatif, tapez `{COMMAND_PREFIX}aide`. Pour les geek tapez `{COMMAND_PREFIX}aide -v`.",
@@ -18,11 +19,15 @@ class AlbertMsg:
         "debug": f"Pour afficher des informations sur la configuration actuelle, `{COMMAND_PREFIX}debug`",
         "model": f"Pour modifier le modèle, tapez `{COMMAND_PREFIX}model MODEL_NAME`",
         "mode": f"Pour modifier le mode du modèle (c'est-à-dire le modèle de prompt utilisé), tapez `{COMMAND_PREFIX}mode MODE`",
-        "sources": f"Pour obtenir les sources utilisées pour générer ma dernière réponse, tapez `{COMMAND_PREFIX}sources`",
+        "sources": f"Pour obtenir les sources utilisées pour générer ma dernière réponse, tapez `{COMMAND_PREFIX}sources` (en réponse à un de mes messages pour obtenir ses sources, ou réagissez-y avec {SOURCES_REACTION})",
     }
 
     failed = "🤖 Albert a échoué à répondre. Veuillez réessayez dans un moment."
 
+    unavailable = (
+        "🤖 Albert est momentanément indisponible. Veuillez réessayer dans quelques minutes."
+    )
+
     flush_start = "Nettoyage des collections RAG propres à cette conversation..."
 
     flush_end = "Nettoyage des collections RAG terminé."
@@ -70,11 +75,28 @@ class AlbertMsg:
         msg += "Entrez **!aide** pour obtenir plus d'informatin sur ma paramétrisatiion."
         return msg
 
-    def debug(config: Config):
+    def missed_messages(n_messages):
+        msg = f"Albert était indisponible quand vous avez envoyé {n_messages} message(s). "
+        msg += "Je réponds à votre dernier message."
+        return msg
+
+    def missed_messages_summary(n_messages, summary):
+        msg = f"Albert était indisponible quand vous avez envoyé {n_messages} message(s). "
+        msg += f"En résumé :\n\n{summary}\n\nJe réponds à votre dernier message."
+        return msg
+
+    def summarise_prompt(messages):
+        msg = "Résume en quelques phrases les messages suivants, envoyés par un utilisateur "
+        msg += f"pendant que tu étais indisponible :\n\n{messages}"
+        return msg
+
+    def debug(config: Config, last_request: str | None = None):
         msg = "🤖 Configuration actuelle :\n\n"
         msg += f"- Version: {APP_VERSION}\n"
         msg += f"- API: {config.albert_api_url}\n"
         msg += f"- Model: {config.albert_model}\n"
         msg += f"- Mode: {config.albert_mode}\n"
         msg += f"- With history: {config.albert_with_history}\n"
+        if last_request:
+            msg += f"\nDernière requête :\n\n{last_request}\n"
         return msg
@@ -0,0 +1,139 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import time
+from contextlib import contextmanager
+
+import aiohttp
+import httpx
+import openai
+import requests
+from matrix_bot.config import logger
+from matrix_bot.metrics import Histogram, metrics
+
+
+class CircuitOpenError(Exception):
+    """The endpoint failed too often recently: the request is not even sent"""
+
+
+def is_failure(error: Exception) -> bool:
+    """Errors telling that the endpoint is unhealthy, as opposed to a bad request"""
+    if isinstance(error, (requests.Timeout, requests.ConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError)):
+        return True
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of an API endpoint, with a timeout adapted to its observed latency.
+
+    - closed: requests go through. After `failure_threshold` failures in a row, it opens.
+    - open: requests fail immediately with CircuitOpenError, for `reset_timeout` seconds.
+    - half-open: one trial request goes through; it closes the circuit if it succeeds,
+      and opens it again otherwise.
+
+    The timeout is `timeout_factor` times the `percentile` of the successful requests,
+    bounded by `min_timeout` and `max_timeout` (`max_timeout` until enough requests are seen).
+    """
+
+    MIN_SAMPLES = 20
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        min_timeout: float = 5,
+        max_timeout: float = 60,
+        percentile: float = 0.99,
+        timeout_factor: float = 3,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.percentile = percentile
+        self.timeout_factor = timeout_factor
+        self.latency = Histogram()
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    @property
+    def timeout(self) -> float:
+        if self.latency.count < self.MIN_SAMPLES:
+            return self.max_timeout
+        adaptive = self.latency.quantile(self.percentile) * self.timeout_factor
+        return min(self.max_timeout, max(self.min_timeout, adaptive))
+
+    @contextmanager
+    def guard(self):
+        """
+        Run a request through the breaker, the with block gets the timeout to use:
+            with breaker.guard() as timeout:
+                requests.post(url, timeout=timeout)
+        """
+        state = self.state
+        if state == "open" or (state == "half-open" and self.trial_in_flight):
+            metrics.counter(
+                "albert_circuit_rejected_total", "Requests failed fast", endpoint=self.name
+            ).inc()
+            raise CircuitOpenError(f"Albert API {self.name} endpoint is unavailable")
+
+        is_trial = state == "half-open"
+        self.trial_in_flight = self.trial_in_flight or is_trial
+        start = time.perf_counter()
+        try:
+            yield self.timeout
+        except Exception as error:
+            if is_failure(error) or is_trial:
+                self._record_failure(error)
+            raise
+        else:
+            self.latency.observe(time.perf_counter() - start)
+            self._record_success()
+        finally:
+            if is_trial:
+                self.trial_in_flight = False
+
+    def _record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("Circuit closed", endpoint=self.name)
+            self._set_state_gauge(0)
+        self.failures = 0
+        self.opened_at = None
+
+    def _record_failure(self, error: Exception) -> None:
+        self.failures += 1
+        if self.failures >= self.failure_threshold or self.opened_at is not None:
+            logger.warning(
+                "Circuit opened", endpoint=self.name, failures=self.failures, error=str(error)
+            )
+            self.opened_at = time.monotonic()
+            self._set_state_gauge(1)
+
+    def _set_state_gauge(self, value: int) -> None:
+        metrics.gauge("albert_circuit_open", "1 while the circuit is open", endpoint=self.name).set(
+            value
+        )
@@ -0,0 +1,158 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+What the bot knows of the documents of the collections, by collection name (the room id for
+the private collections). An index is only valid for the collection id it was built for: a
+collection created again after a flush starts with an empty index.
+
+The document list (manifest) is kept in memory: it is updated on upload, and fetched again
+from the Albert API once older than `albert_documents_ttl`, to catch up with the changes made
+by other processes. The content hashes of the uploaded documents can't be found again from
+the API: they are stored in a sqlite database shared by the processes, to survive restarts.
+"""
+
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+
+from matrix_bot.metrics import metrics
+
+from config import Config, env_config
+from core_llm import get_documents
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS document_hashes (
+    collection_name TEXT NOT NULL,
+    collection_id TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    document_name TEXT NOT NULL,
+    PRIMARY KEY (collection_name, collection_id, digest)
+);
+"""
+
+
+@dataclass
+class CollectionIndex:
+    collection_id: str
+    documents: dict[str, dict] | None = None  # id -> document, None until fetched
+    synced_at: float = 0.0
+
+
+class HashStore:
+    """Names of the documents uploaded in each collection, by sha256 of their content"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._db: sqlite3.Connection | None = None
+        # The queries run in the threads of asyncio.to_thread, not to block the event loop
+        self._lock = threading.Lock()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None, check_same_thread=False
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    async def get(self, collection: dict, digest: str) -> str | None:
+        return await asyncio.to_thread(self._get, collection["name"], collection["id"], digest)
+
+    def _get(self, collection_name: str, collection_id: str, digest: str) -> str | None:
+        with self._lock:
+            row = self.db.execute(
+                "SELECT document_name FROM document_hashes"
+                " WHERE collection_name = ? AND collection_id = ? AND digest = ?",
+                (collection_name, collection_id, digest),
+            ).fetchone()
+        return row[0] if row else None
+
+    async def add(self, collection: dict, digest: str, document_name: str) -> None:
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO document_hashes VALUES (?, ?, ?, ?)",
+            (collection["name"], collection["id"], digest, document_name),
+        )
+
+    async def forget(self, collection_name: str) -> None:
+        await asyncio.to_thread(
+            self._execute,
+            "DELETE FROM document_hashes WHERE collection_name = ?",
+            (collection_name,),
+        )
+
+    def _execute(self, query: str, params: tuple) -> None:
+        with self._lock:
+            self.db.execute(query, params)
+
+
+hash_store = HashStore(env_config.documents_index_path)
+_indexes: dict[str, CollectionIndex] = {}
+# An upload checks that the document isn't in the collection yet, then records it: two uploads
+# of the same document in a collection must not run concurrently. (The private collections are
+# handled by the shard of their room.)
+_upload_locks: dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+def upload_lock(collection_name: str) -> asyncio.Lock:
+    return _upload_locks[collection_name]
+
+
+def get_index(collection: dict) -> CollectionIndex:
+    index = _indexes.get(collection["name"])
+    if index is None or index.collection_id != collection["id"]:
+        index = _indexes[collection["name"]] = CollectionIndex(collection["id"])
+    return index
+
+
+async def list_documents(config: Config, collection: dict) -> list[dict]:
+    """Documents of the collection, from the manifest if it is recent enough"""
+    index = get_index(collection)
+    result = "local"
+    if index.documents is None or time.monotonic() - index.synced_at > config.albert_documents_ttl:
+        documents = await asyncio.to_thread(get_documents, config, collection["id"])
+        index.documents = {document["id"]: document for document in documents}
+        index.synced_at = time.monotonic()
+        result = "fetch"
+    metrics.counter("albert_documents_manifest_total", "Document listings", result=result).inc()
+    return list(index.documents.values())
+
+
+async def find_duplicate(collection: dict, digest: str) -> str | None:
+    """Name of the document of the collection with the same content, if any"""
+    return await hash_store.get(collection, digest)
+
+
+async def record_upload(collection: dict, name: str, digest: str, response: dict) -> None:
+    """Add the document to the index, given the answer of the /files endpoint"""
+    await hash_store.add(collection, digest, name)
+    index = get_index(collection)
+    if index.documents is None:
+        return
+    uploads = [u for u in response.get("data", []) if u.get("status", "success") == "success"]
+    if not uploads:  # Unexpected answer, fetch the documents next time
+        index.documents = None
+    for upload in uploads:
+        index.documents[upload["id"]] = {"id": upload["id"], "name": name}
+
+
+async def forget(collection_name: str) -> None:
+    """To call once the collection is flushed or deleted"""
+    _indexes.pop(collection_name, None)
+    await hash_store.forget(collection_name)
+
+
+def content_hash(content: bytes) -> str:
+    # The sha256 of the attachment event is the one of the encrypted file, which changes
+    # every time the same file is sent.
+    return hashlib.sha256(content).hexdigest()
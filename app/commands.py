@@ -8,26 +8,43 @@ import traceback
 from collections import defaultdict
 from dataclasses import dataclass
 from functools import wraps
+from typing import Awaitable
 
 from matrix_bot.client import MatrixClient
 from matrix_bot.config import logger
 from matrix_bot.eventparser import EventNotConcerned, EventParser
-from nio import Event, RoomEncryptedFile, RoomMemberEvent, RoomMessageText
+from matrix_bot.executor import run_cpu
+from matrix_bot.metrics import metrics
+from matrix_bot.room_utils import room_is_direct_message
+from matrix_bot.tracing import last_trace_summary
+from nio import (
+    Event,
+    MatrixRoom,
+    ReactionEvent,
+    RoomEncryptedFile,
+    RoomMemberEvent,
+    RoomMessageText,
+)
 
+import background
+import collection_index
+import reaper
 from bot_msg import AlbertMsg
-from config import COMMAND_PREFIX, Config
+from circuit_breaker import CircuitOpenError
+from config import COMMAND_PREFIX, SOURCES_REACTION, Config
 from core_llm import (
     flush_collections_with_name,
     get_all_public_collections,
     get_or_create_collection_with_name,
     get_or_not_collection_with_name,
-    get_documents,
     generate,
     get_available_models,
     get_available_modes,
+    start_search,
     upload_file,
 )
 from iam import TchapIam
+from sources import sources_store
 from tchap_utils import (
     get_cleanup_body, 
     get_decrypted_file,
@@ -132,11 +149,67 @@ async def log_not_allowed(msg: str, ep: EventParser, matrix_client: MatrixClient
                 print("Failed to find error room ?!")
 
 
+async def summarise_missed_messages(room: MatrixRoom, events: list, matrix_client: MatrixClient):
+    """Catch-up handler: summarise the messages sent while Albert was down"""
+    sender = events[-1].sender
+    if not room_is_direct_message(room):
+        return
+    config = user_configs[sender]
+    is_allowed, _ = await tiam.is_user_allowed(config, sender)
+    if not is_allowed:
+        return
+    # The summary only needs the missed messages: no search, no history
+    summary_config = config.model_copy(
+        update={"albert_mode": "norag", "albert_with_history": False}
+    )
+    missed = "\n".join(f"- {get_cleanup_body(event)}" for event in events)
+    prompt = AlbertMsg.summarise_prompt(missed)
+    try:
+        summary, _ = await generate(summary_config, [{"role": "user", "content": prompt}])
+        msg = AlbertMsg.missed_messages_summary(len(events), summary)
+    except Exception as albert_err:
+        logger.warning("Could not summarise the missed messages", error=str(albert_err))
+        msg = AlbertMsg.missed_messages(len(events))
+    await matrix_client.send_markdown_message(room.room_id, msg, msgtype="m.notice")
+
+
 # ================================================================================
 # Decorators
 # ================================================================================
 
 
+async def flush_room_collections(
+    config: Config, room_id: str, matrix_client: MatrixClient | None = None
+) -> None:
+    """Flush the private collection of the room, and tell the user once done if a client is given"""
+    try:
+        await asyncio.to_thread(flush_collections_with_name, config, room_id)
+    except Exception as flush_error:
+        if matrix_client:
+            message = AlbertMsg.failed
+            if isinstance(flush_error, CircuitOpenError):
+                message = AlbertMsg.unavailable
+            await matrix_client.send_markdown_message(room_id, message, msgtype="m.notice")
+        raise  # logged by background
+    await collection_index.forget(room_id)
+    if matrix_client:
+        await matrix_client.send_markdown_message(room_id, AlbertMsg.flush_end, msgtype="m.notice")
+
+
+def schedule_flush(config: Config, room_id: str, matrix_client: MatrixClient | None = None) -> None:
+    """
+    Flush the private collection of the room in the background, the next messages of the user
+    don't wait for it (it is removed from the collections they search right away).
+    The uploads wait for it, with background.wait(room_id).
+    """
+    config.albert_collections_by_id = {
+        collection_id: collection
+        for collection_id, collection in config.albert_collections_by_id.items()
+        if collection["name"] != room_id
+    }
+    background.spawn(room_id, flush_room_collections(config, room_id, matrix_client), name="flush")
+
+
 def register_feature(
     group: str,
     onEvent: Event,
@@ -254,11 +327,8 @@ async def albert_reset(ep: EventParser, matrix_client: MatrixClient):
 
         message = AlbertMsg.flush_start
         await matrix_client.send_markdown_message(ep.room.room_id, message, msgtype="m.notice")  
-        await matrix_client.room_typing(ep.room.room_id)
-        flush_collections_with_name(config, ep.room.room_id)
         config.albert_collections_by_id = {}
-        message = AlbertMsg.flush_end
-        await matrix_client.send_markdown_message(ep.room.room_id, message, msgtype="m.notice")  
+        schedule_flush(config, ep.room.room_id, matrix_client)
 
     else:
         await matrix_client.send_markdown_message(
@@ -299,7 +369,8 @@ async def albert_conversation(ep: EventParser, matrix_client: MatrixClient):
 @only_allowed_user
 async def albert_debug(ep: EventParser, matrix_client: MatrixClient):
     config = user_configs[ep.sender]
-    debug_message = AlbertMsg.debug(config)
+    last_request = last_trace_summary(ep.room.room_id)
+    debug_message = AlbertMsg.debug(config, last_request=last_request)
     await matrix_client.send_markdown_message(ep.room.room_id, debug_message, msgtype="m.notice")
 
 
@@ -317,7 +388,7 @@ async def albert_model(ep: EventParser, matrix_client: MatrixClient):
     await matrix_client.room_typing(ep.room.room_id)
     command = ep.get_command()
     # Get all available models
-    all_models = list(get_available_models(config))
+    all_models = list(await asyncio.to_thread(get_available_models, config))
     models_list = "\n\n- " + "\n- ".join(
         map(lambda x: x + (" *" if x == config.albert_model else ""), all_models)
     )
@@ -371,11 +442,8 @@ async def albert_mode(ep: EventParser, matrix_client: MatrixClient):
     if mode == "norag":
         message = AlbertMsg.flush_start
         await matrix_client.send_markdown_message(ep.room.room_id, message, msgtype="m.notice")  
-        await matrix_client.room_typing(ep.room.room_id)
-        flush_collections_with_name(config, ep.room.room_id)
         config.albert_collections_by_id = {}
-        message = AlbertMsg.flush_end
-        await matrix_client.send_markdown_message(ep.room.room_id, message, msgtype="m.notice")  
+        schedule_flush(config, ep.room.room_id, matrix_client)
 
 
 @register_feature(
@@ -386,16 +454,54 @@ async def albert_mode(ep: EventParser, matrix_client: MatrixClient):
 )
 @only_allowed_user
 async def albert_sources(ep: EventParser, matrix_client: MatrixClient):
+    if isa_reply_to(ep.event):
+        # The sources of the answer replied to
+        answer_id = ep.event.source["content"]["m.relates_to"]["m.in_reply_to"]["event_id"]
+        await send_sources(ep, matrix_client, sources_store.get(answer_id))
+    else:
+        await send_sources(ep, matrix_client, sources_store.last(ep.room.room_id))
+
+
+@register_feature(
+    group="albert",
+    onEvent=ReactionEvent,
+    help=None,
+)
+async def albert_sources_reaction(ep: EventParser, matrix_client: MatrixClient):
+    """Send the sources of an answer when the user reacts to it with SOURCES_REACTION"""
+    # Checked before the user, not to answer the other reactions of a non-allowed user
+    if ep.event.key != SOURCES_REACTION:
+        raise EventNotConcerned
+    try:
+        refs = await sources_store.get(ep.event.reacts_to)
+    except Exception as sources_error:
+        logger.error("Could not read the sources", error=str(sources_error))
+        raise EventNotConcerned
+    if refs is None:  # Not an answer
+        raise EventNotConcerned
+    await send_reaction_sources(ep, matrix_client)
+
+
+@only_allowed_user
+async def send_reaction_sources(ep: EventParser, matrix_client: MatrixClient):
+    await send_sources(ep, matrix_client, sources_store.get(ep.event.reacts_to))
+
+
+async def send_sources(
+    ep: EventParser, matrix_client: MatrixClient, refs_lookup: Awaitable[list[dict] | None]
+):
+    """Send the chunks found by `refs_lookup` (a query of the sources store)"""
     config = user_configs[ep.sender]
 
     try:
-        if config.last_rag_chunks:
+        refs = await refs_lookup
+        if refs:
             await matrix_client.room_typing(ep.room.room_id)
             sources_msg = ""
-            for chunk in config.last_rag_chunks[:max(30, len(config.last_rag_chunks))]:
+            for chunk in await sources_store.load_contents(config, refs):
                 sources_msg += f'________________________________________\n'
-                sources_msg += f'####{chunk["metadata"]["document_name"]}\n'
-                sources_msg += f'{chunk["content"]}\n'
+                sources_msg += f'####{chunk["document_name"]}\n'
+                sources_msg += f'{chunk["content"] or "_(contenu indisponible)_"}\n'
         else:
             sources_msg = "Aucune source trouvée, veuillez me poser une question d'abord."
     except Exception:
@@ -441,17 +547,20 @@ async def albert_collection(ep: EventParser, matrix_client: MatrixClient):
                     f"{collection_infos}\n\n"
                     "sont prises en compte pour m'aider à répondre à vos questions."
                 )
-            collections = get_all_public_collections(config)
+            collections = await asyncio.to_thread(get_all_public_collections, config)
             message += "\n\nNotez que les collections publiques à votre disposition sont:\n"
             message += '\n - ' + '\n - '.join([f"{c['name']}" for c in collections])
             message += f"\n\nVous pouvez toutes les ajouter d'un coup en utilisant la commande `!collections use {config.albert_all_public_command}`"
         elif method == 'info':
             collection_name = command[2] if command[2] != config.albert_my_private_collection_name else ep.room.room_id
-            collection = get_or_not_collection_with_name(config, collection_name)
+            await background.wait(collection_name)  # a flush of the private collection
+            collection = await asyncio.to_thread(
+                get_or_not_collection_with_name, config, collection_name
+            )
             if not collection:
                 message = f"La collection {collection_name} n'existe pas."
             else:
-                document_infos = [f"{d['name']} ({d['id']})" for d in get_documents(config, collection['id'])]
+                document_infos = [f"{d['name']} ({d['id']})" for d in await collection_index.list_documents(config, collection)]
                 if not document_infos:
                     message = (
                         f"Collection '{command[2]}' ({collection['id']}) : \n\n"
@@ -467,9 +576,11 @@ async def albert_collection(ep: EventParser, matrix_client: MatrixClient):
                     )
         elif method == 'use':
             if command[2] == config.albert_all_public_command:
-                collections = get_all_public_collections(config)
+                collections = await asyncio.to_thread(get_all_public_collections, config)
             else:
-                collection = get_or_not_collection_with_name(config, command[2])
+                collection = await asyncio.to_thread(
+                    get_or_not_collection_with_name, config, command[2]
+                )
                 if not collection:
                     message = f"La collection {command[2]} n'existe pas."
                     collections = []
@@ -509,17 +620,39 @@ async def albert_document(ep: EventParser, matrix_client: MatrixClient):
         await matrix_client.room_typing(ep.room.room_id)
         if ep.event.mimetype in ['application/json', 'application/pdf', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
             config.update_last_activity()       
+            reaper.touch(ep.room.room_id)
             config.albert_mode = "rag"
-            collection = get_or_create_collection_with_name(config, ep.room.room_id)
+            # A flush still running would delete the collection along with the new document
+            await background.wait(ep.room.room_id)
+            collection = await asyncio.to_thread(
+                get_or_create_collection_with_name, config, ep.room.room_id
+            )
             config.albert_collections_by_id[collection['id']] = collection
             file = await get_decrypted_file(ep)
-            upload_file(config, file, collection['id'])
-            private_document_infos = [d['name'] for d in get_documents(config, collection['id'])]
+            # Don't parse and embed again a document already in the collection
+            digest = await run_cpu(collection_index.content_hash, file.getvalue())
+            async with collection_index.upload_lock(collection["name"]):
+                duplicate_name = await collection_index.find_duplicate(collection, digest)
+                result = "duplicate" if duplicate_name else "new"
+                metrics.counter(
+                    "albert_upload_total", "Documents sent by the users", result=result
+                ).inc()
+                if duplicate_name:
+                    status = f'est déjà dans votre collection privée ("{duplicate_name}").'
+                else:
+                    upload_response = await asyncio.to_thread(
+                        upload_file, config, file, collection["id"]
+                    )
+                    await collection_index.record_upload(
+                        collection, file.name, digest, upload_response
+                    )
+                    status = "a été chargé dans votre collection privée."
+            private_document_infos = [d['name'] for d in await collection_index.list_documents(config, collection)]
             private_document_infos_message = '\n - ' + '\n - '.join(private_document_infos)
             response = (
                 "Votre document : \n\n"
                 f"\"{file.name}\"\n\n"
-                "a été chargé dans votre collection privée.\n\n"
+                f"{status}\n\n"
                 "Voici les documents actuellement présents dans votre collection privée : \n\n"
                 f"{private_document_infos_message}"
                 "\n\n"
@@ -533,7 +666,11 @@ async def albert_document(ep: EventParser, matrix_client: MatrixClient):
                 "Veuillez téléverser un fichier PDF, DOCX ou JSON."
             )
         await matrix_client.send_markdown_message(ep.room.room_id, response, msgtype="m.notice")
-    
+
+    except CircuitOpenError:
+        await matrix_client.send_markdown_message(
+            ep.room.room_id, AlbertMsg.unavailable, msgtype="m.notice"
+        )
     except Exception as albert_err:
         logger.error(f"{albert_err}")
         traceback.print_exc()
@@ -562,19 +699,29 @@ async def albert_answer(ep: EventParser, matrix_client: MatrixClient):
     if ep.is_command(COMMAND_PREFIX):
         raise EventNotConcerned
 
+    reset_notice = None
     if config.albert_with_history and config.is_conversation_obsolete:
         config.albert_history_lookup = 0
         obsolescence_in_minutes = str(config.conversation_obsolescence // 60)
         reset_message = AlbertMsg.reset_notif(obsolescence_in_minutes)
-        await matrix_client.send_markdown_message(
-            ep.room.room_id, reset_message, msgtype="m.notice"
+        # Not awaited: the answer doesn't depend on them (the notice is awaited before sending it)
+        reset_notice = background.spawn(
+            ep.room.room_id,
+            matrix_client.send_markdown_message(ep.room.room_id, reset_message, msgtype="m.notice"),
+            name="reset_notice",
         )
-        flush_collections_with_name(config, ep.room.room_id)
-        config.albert_collections_by_id = {}
+        schedule_flush(config, ep.room.room_id)
 
     config.update_last_activity()
+    reaper.touch(ep.room.room_id)
     await matrix_client.room_typing(ep.room.room_id)
+    prefetch = None
     try:
+        # The search on the last message doesn't need the history: it runs while it is fetched.
+        # (A rewritten search query depends on the history.)
+        if config.albert_mode == "rag" and not config.albert_query_rewrite:
+            prefetch = start_search(config, get_cleanup_body(ep.event))
+
         # Build the messages  history
         # --
         is_reply_to = isa_reply_to(ep.event)
@@ -609,9 +756,18 @@ async def albert_answer(ep: EventParser, matrix_client: MatrixClient):
         if not messages:
             messages = [{"role": "user", "content": user_query}]
 
-        answer = generate(config, messages)
+        answer, rag_chunks = await generate(config, messages, prefetch)
 
+    except CircuitOpenError:
+        # Albert is known to be down: tell the user right away, the errors room already knows.
+        await matrix_client.send_markdown_message(
+            ep.room.room_id, AlbertMsg.unavailable, msgtype="m.notice"
+        )
+        config.albert_history_lookup = initial_history_lookup
+        return
     except Exception as albert_err:
+        if prefetch:
+            prefetch.cancel()
         logger.error(f"{albert_err}")
         traceback.print_exc()
         # Send an error message to the user
@@ -637,19 +793,25 @@ async def albert_answer(ep: EventParser, matrix_client: MatrixClient):
         # "content" -> "m.relates_to": {"m.in_reply_to": {"event_id": ep.event.event_id}},
         reply_to = ep.event.event_id
 
-    try:  # sometimes the async code fail (when input is big) with random asyncio errors
-        await matrix_client.send_markdown_message(ep.room.room_id, answer, reply_to=reply_to)
+    if reset_notice:
+        await asyncio.wait({reset_notice})
+    try:  # rate limits are retried by the matrix client send queue
+        answer_id = await matrix_client.send_markdown_message(
+            ep.room.room_id, answer, reply_to=reply_to
+        )
+        if answer_id:
+            try:
+                # Also without chunks, for `!sources` not to show those of an older answer
+                await sources_store.save(answer_id, ep.room.room_id, rag_chunks)
+            except Exception as sources_error:  # The answer is sent all the same
+                logger.error(
+                    "Could not save the sources", event_id=answer_id, error=str(sources_error)
+                )
         await tiam.increment_user_question(ep.sender)
-    except Exception as llm_exception:  # it seems to work when we retry
-        logger.error(f"asyncio error when sending message {llm_exception=}. retrying")
-        await asyncio.sleep(1)
-        try:
-            # Try once more
-            await matrix_client.send_markdown_message(ep.room.room_id, answer, reply_to=reply_to)
-            await tiam.increment_user_question(ep.sender)
-        except:
-            config.albert_history_lookup = initial_history_lookup
-            return
+    except Exception as llm_exception:
+        logger.error(f"error when sending message {llm_exception=}")
+        config.albert_history_lookup = initial_history_lookup
+        return
 
     # Add agent answer in the history count
     if not is_reply_to:
@@ -668,7 +830,7 @@ async def albert_wrong_command(ep: EventParser, matrix_client: MatrixClient):
     ep.do_not_accept_own_message()  # avoid infinite loop
     ep.only_on_direct_message()  # Only in direct room for now (need a spec for "saloon" conversation)
 
-    command = ep.event.body.strip().lstrip(COMMAND_PREFIX).split()
+    command = ep.body_without_reply_fallback().lstrip(COMMAND_PREFIX).split()
     if not ep.is_command(COMMAND_PREFIX):
         # Not a command
         raise EventNotConcerned
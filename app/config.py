@@ -13,6 +13,7 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 from _version import __version__
 
 COMMAND_PREFIX = "!"
+SOURCES_REACTION = "📚"  # Reaction to an answer asking for its sources
 
 APP_VERSION = __version__
 
@@ -50,6 +51,82 @@ class Config(BaseConfig):
     # Albert API settings
     albert_api_url: str = Field("http://localhost:8090", description="Albert API base URL")
     albert_api_token: str = Field("", description="Albert API Token")
+    albert_circuit_failures: int = Field(
+        5, description="Consecutive failures of an Albert API endpoint before failing fast"
+    )
+    albert_circuit_reset: int = Field(
+        30, description="Seconds of failing fast before an Albert API endpoint is tried again"
+    )
+    albert_answer_cache: bool = Field(
+        False, description="Reuse the answers to the same single-turn questions on public data"
+    )
+    albert_answer_cache_ttl: int = Field(
+        3600, description="Lifetime of a cached answer, in seconds"
+    )
+    albert_answer_cache_size: int = Field(1000, description="Max number of cached answers")
+    albert_hedging: bool = Field(
+        False, description="Send a hedged request to a fallback model when a completion is slow"
+    )
+    albert_fallback_models: list[str] = Field(
+        [], description="Fallback models of the hedged requests, by order of preference"
+    )
+    albert_hedging_percentile: float = Field(
+        0.95, description="Hedge once a completion is slower than this percentile of the model"
+    )
+    albert_hedging_min_samples: int = Field(
+        20, description="Completions observed before the percentile is used to hedge"
+    )
+    albert_hedging_default_delay: float = Field(
+        10.0, description="Hedging delay in seconds while there are not enough samples"
+    )
+    albert_search_fanout: int = Field(
+        4, description="Max number of concurrent /search requests, each on a group of collections"
+    )
+    albert_search_deadline: float = Field(
+        5.0, description="Seconds after which a search leaves out the collections not answering"
+    )
+    albert_query_rewrite: bool = Field(
+        False, description="Rewrite the follow-up questions into standalone search queries"
+    )
+    albert_query_rewrite_model: str = Field(
+        "", description="Small model rewriting the search queries (the chat model if empty)"
+    )
+    albert_query_rewrite_turns: int = Field(
+        4, description="Previous messages given to the model rewriting the search query"
+    )
+    albert_query_rewrite_timeout: float = Field(
+        3.0, description="Seconds after which the raw message is used as search query"
+    )
+    albert_rerank: bool = Field(False, description="Re-rank the searched chunks locally")
+    albert_rerank_candidates: int = Field(
+        20, description="Chunks searched to be re-ranked, of which the 7 best are kept"
+    )
+    albert_reaper_interval: int = Field(
+        0,
+        description="Seconds between two reaps of the private collections of the rooms idle for "
+        "albert_reaper_max_idle, which deletes the documents sent in them. 0 (default) disables "
+        "it, e.g. ALBERT_REAPER_INTERVAL=3600 to reap them every hour",
+    )
+    albert_reaper_max_idle: int = Field(
+        7 * 24 * 3600,
+        description="Idle time of a room after which its private collection is reaped",
+    )
+    albert_documents_ttl: int = Field(
+        300, description="Seconds the local list of the documents of a collection is trusted"
+    )
+    albert_reaper_batch_size: int = Field(10, description="Private collections deleted at once")
+
+    sources_path: Path = Field(
+        "/data/sources.sqlite", description="Database of the sources of the answers"
+    )
+    documents_index_path: Path = Field(
+        "/data/documents.sqlite",
+        description="Database of the content hashes of the uploaded documents, "
+        "not to upload the same document twice in a collection",
+    )
+    sources_max_answers: int = Field(
+        100_000, description="Number of answers whose sources are kept (the most recent ones)"
+    )
 
     # Albert Conversation settings
     # ============================
@@ -70,7 +147,6 @@ class Config(BaseConfig):
     conversation_obsolescence: int = Field(
         15 * 60, description="time after which a conversation is considered obsolete, in seconds"
     )
-    last_rag_chunks: list[dict] | None = Field(None, description="Last chunks used for the RAG.")
 
     @property
     def is_conversation_obsolete(self) -> bool:
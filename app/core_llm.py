@@ -2,17 +2,59 @@
 #
 # SPDX-License-Identifier: MIT
 
+import asyncio
+import hashlib
 import os
+import re
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
 from io import BytesIO
 
+import aiohttp
 import requests
 from jinja2 import BaseLoader, Environment, Template, meta
-from openai import OpenAI
+from matrix_bot.config import logger
+from matrix_bot.executor import run_cpu
+from matrix_bot.metrics import metrics
+from matrix_bot.tracing import span, traced
+from openai import AsyncOpenAI
 
-from config import Config
-from utils import log_and_raise_for_status
+from circuit_breaker import CircuitBreaker, is_failure
+from config import Config, env_config
+from rerank import rerank
+from utils import TTLCache, alog_and_raise_for_status, log_and_raise_for_status, retry
 
 API_PREFIX_V1 = "v1"
+MODELS_CACHE_TTL = 600
+FLUSH_CONCURRENCY = 8  # documents deleted at once when a collection can't be deleted
+
+_models_cache: dict[tuple[str, str], tuple[float, dict]] = {}
+_openai_clients: dict[tuple[str, str], tuple[asyncio.AbstractEventLoop, AsyncOpenAI]] = {}
+
+answer_cache = TTLCache(env_config.albert_answer_cache_size, env_config.albert_answer_cache_ttl)
+rewrite_cache = TTLCache(1000, 3600)
+
+# One breaker by endpoint, with the bounds of its adaptive timeout (seconds)
+albert_breakers = {
+    endpoint: CircuitBreaker(
+        endpoint,
+        failure_threshold=env_config.albert_circuit_failures,
+        reset_timeout=env_config.albert_circuit_reset,
+        min_timeout=min_timeout,
+        max_timeout=max_timeout,
+    )
+    for endpoint, min_timeout, max_timeout in (
+        ("search", 5, 30),
+        ("chat", 20, 180),
+        ("rewrite", 5, 30),  # short completions, see rewrite_query
+        ("files", 30, 300),
+        ("collections", 5, 60),  # collections and documents management
+        ("models", 5, 30),
+    )
+}
 
 
 SYSTEM_PROMPT = '''
@@ -27,45 +69,272 @@ N'induis pas l'utilisateur dans l'erreur.
 En particulier, souviens toi que tu es un LLM donc qu'il t'arrive de te tromper.
 '''
 
+RAG_PROMPT_TEMPLATE = """Utilisez le contexte suivant comme votre base de connaissances, à l'intérieur des balises XML <context></context>.
+
+<context>
+{% for chunk in chunks %}
+id: {{chunk.id}}
+document: {{chunk.metadata.document_name}}
+content: {{chunk.content}} {% if not loop.last %}{{"\n"}}{% endif %}
+{% endfor %}
+</context>
+
+
+Lors de la réponse à l'utilisateur :
+- Si vous ne savez pas ou si vous n'êtes pas sûr, demandez une clarification.
+- Évitez de mentionner que vous avez obtenu les informations du contexte.
+
+Étant donné les sources d'informations du contexte, répondez à la question.
+Question : {{query}}
+"""
+
+QUERY_REWRITE_PROMPT = """Voici une conversation entre un utilisateur et un assistant :
+
+{history}
+
+Reformule la dernière question de l'utilisateur en une question autonome, compréhensible sans la conversation, pour une recherche dans une base documentaire.
+Réponds uniquement avec la question reformulée.
+
+Dernière question : {query}"""
+
+# Changes with the prompts, so that the cached answers of the former prompts are not used.
+PROMPT_TEMPLATE_VERSION = hashlib.sha256(
+    (SYSTEM_PROMPT + RAG_PROMPT_TEMPLATE).encode()
+).hexdigest()[:12]
+
+
+@retry()
 def get_available_models(config: Config) -> dict:
-    """Fetch available models"""
+    """Fetch available models (cached for MODELS_CACHE_TTL seconds)"""
     api_key = config.albert_api_token
     url = os.path.join(config.albert_api_url, API_PREFIX_V1)
+    cached = _models_cache.get((url, api_key))
+    if cached and time.time() - cached[0] < MODELS_CACHE_TTL:
+        return cached[1]
     headers = {"Authorization": f"Bearer {api_key}"}
-    response = requests.get(f"{url}/models", headers=headers)
-    log_and_raise_for_status(response)
+    with albert_breakers["models"].guard() as timeout, albert_latency("models"):
+        response = requests.get(f"{url}/models", headers=headers, timeout=timeout)
+        log_and_raise_for_status(response)
     data = response.json()
     models = {v["id"]: v for v in data["data"] if v["type"] == "text-generation"}
+    _models_cache[(url, api_key)] = (time.time(), models)
     return models
 
 
+async def get_hedging_policy(config: Config) -> tuple[str | None, float | None]:
+    """
+    Return the fallback model and the delay after which it is requested,
+    or (None, None) if the completions of the user model should not be hedged.
+    """
+    if not config.albert_hedging:
+        return None, None
+    try:
+        available = await asyncio.to_thread(get_available_models, config)
+    except Exception as models_error:
+        logger.warning("Hedging disabled, the models could not be fetched", error=str(models_error))
+        return None, None
+    fallback_model = next(
+        (
+            model
+            for model in config.albert_fallback_models
+            if model in available and model != config.albert_model
+        ),
+        None,
+    )
+    if not fallback_model:
+        return None, None
+
+    latency = chat_latency(config.albert_model)
+    if latency.count < config.albert_hedging_min_samples:
+        return fallback_model, config.albert_hedging_default_delay
+    return fallback_model, latency.quantile(config.albert_hedging_percentile)
+
+
+def answer_cache_key(config: Config, messages: list[dict]) -> tuple | None:
+    """
+    Key of the answer cache, or None if the answer must not be cached: the cache is only
+    used for single-turn questions on public collections, as they don't depend on the user.
+    """
+    if not config.albert_answer_cache or len(messages) != 1:
+        return None
+    collections = config.albert_collections_by_id.values()
+    if config.albert_mode == "rag" and any(c.get("type") != "public" for c in collections):
+        return None
+    question = unicodedata.normalize("NFKC", messages[0]["content"]).lower()
+    question = re.sub(r"\s+", " ", question).strip(" ?!.")
+    return (
+        config.albert_model,
+        config.albert_mode,
+        question,
+        tuple(sorted(config.albert_collections_by_id)) if config.albert_mode == "rag" else (),
+        PROMPT_TEMPLATE_VERSION,
+    )
+
+
+async def rewrite_query(aclient: "AlbertApiClient", config: Config, messages: list[dict]) -> str:
+    """
+    Rewrite the last message into a standalone search query, given the previous ones.
+    The raw message is returned if the rewrite fails or is too slow.
+    """
+    query = messages[-1]["content"]
+    model = config.albert_query_rewrite_model or config.albert_model
+    recent = messages[-config.albert_query_rewrite_turns - 1 :]
+    key = (model, tuple(m["content"] for m in recent))
+    rewritten = rewrite_cache.get(key)
+    if rewritten:
+        return rewritten
+
+    history = "\n".join(
+        f"{'Utilisateur' if m['role'] == 'user' else 'Assistant'} : {m['content']}"
+        for m in recent[:-1]
+    )
+    prompt = QUERY_REWRITE_PROMPT.format(history=history, query=query)
+    latency = metrics.histogram("albert_query_rewrite_seconds", "Search query rewrite latency")
+    try:
+        with latency.time(), span("rewrite_query", model=model):
+            rewritten = await asyncio.wait_for(
+                aclient._complete(
+                    model,
+                    [{"role": "user", "content": prompt}],
+                    endpoint="rewrite",
+                    temperature=0,
+                    max_tokens=100,
+                ),
+                config.albert_query_rewrite_timeout,
+            )
+    except Exception as rewrite_error:
+        metrics.counter(
+            "albert_query_rewrite_total", "Search query rewrites", result="failed"
+        ).inc()
+        logger.warning("Search query not rewritten", error=str(rewrite_error) or "timeout")
+        return query
+
+    metrics.counter("albert_query_rewrite_total", result="done").inc()
+    rewritten = rewritten.strip() or query
+    rewrite_cache.set(key, rewritten)
+    return rewritten
+
+
+def split_collections(
+    collections: list[str], n_groups: int, private: list[str] = ()
+) -> list[list[str]]:
+    """
+    At most `n_groups` non-empty groups of collections, of similar sizes. Each group is searched
+    with its own k, shared by its collections (not one k per collection, which would take one
+    request per collection). The `private` collections (the documents sent by the user) get a
+    group of their own when there are several groups, so that their chunks are not crowded out
+    by the ones of the public collections.
+    """
+    n_groups = max(1, min(n_groups, len(collections)))
+    own = [c for c in collections if c in private]
+    others = [c for c in collections if c not in private]
+    if own and others and n_groups > 1:
+        n_others = min(n_groups - 1, len(others))
+        return [own] + [others[i::n_others] for i in range(n_others)]
+    return [collections[i::n_groups] for i in range(n_groups)]
+
+
 def get_available_modes(config: Config) -> list[str]:
     """Fetch available modes for the current model"""
     return ["norag", "rag"]
 
 
-def generate(
+def get_search_params(config: Config) -> dict:
+    """Parameters of AlbertApiClient.search_chunks, for the settings of the user"""
+    return {
+        "model_embedding": config.albert_model_embedding,
+        "collections": list(config.albert_collections_by_id.keys()),
+        "private_collections": [
+            collection_id
+            for collection_id, collection in config.albert_collections_by_id.items()
+            if collection.get("type") == "private"
+        ],
+        "limit": 7,
+        "candidates": config.albert_rerank_candidates if config.albert_rerank else None,
+        "fanout": config.albert_search_fanout,
+        "deadline": config.albert_search_deadline,
+    }
+
+
+@dataclass
+class SearchPrefetch:
+    """A search started before the messages are known, see start_search"""
+
+    query: str
+    task: asyncio.Task
+
+    def cancel(self) -> None:
+        self.task.cancel()
+
+
+def start_search(config: Config, query: str) -> SearchPrefetch:
+    """
+    Start the search of the chunks for `query` (the last message of the user), so that it runs
+    while the history is fetched. `generate` uses it if the search query is the same.
+    """
+    url = os.path.join(config.albert_api_url, API_PREFIX_V1)
+    aclient = AlbertApiClient(base_url=url, api_key=config.albert_api_token)
+    task = asyncio.create_task(aclient.search_chunks(query=query, **get_search_params(config)))
+    # Its errors are raised by generate, unless it is not used
+    task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    return SearchPrefetch(query, task)
+
+
+async def generate(
     config: Config, 
-    messages: list
-) -> str:
+    messages: list,
+    prefetch: SearchPrefetch | None = None,
+) -> tuple[str, list[dict]]:
+    """The answer to the messages, and the chunks used by the RAG (or an empty list)"""
+    try:
+        return await _generate(config, messages, prefetch)
+    finally:
+        if prefetch:
+            prefetch.cancel()  # If not used
+
+
+async def _generate(
+    config: Config, 
+    messages: list,
+    prefetch: SearchPrefetch | None = None,
+) -> tuple[str, list[dict]]:
     api_key = config.albert_api_token
     url = os.path.join(config.albert_api_url, API_PREFIX_V1)
     model = config.albert_model
     mode = None if config.albert_mode == "norag" else config.albert_mode
-    collections = list(config.albert_collections_by_id.keys())
     rag_chunks = []
     if not config.albert_with_history:
         messages = messages[-1:]
 
+    cache_key = answer_cache_key(config, messages)
+    if cache_key:
+        cached = answer_cache.get(cache_key)
+        metrics.counter(
+            "albert_answer_cache_total", "Answer cache lookups", result="hit" if cached else "miss"
+        ).inc()
+        if cached:
+            return cached
+
     # Build prompt
     sampling_params: dict = {}
     aclient = AlbertApiClient(base_url=url, api_key=api_key)
     if mode == "rag":
-        messages = aclient.make_rag_prompt(
-            model_embedding=config.albert_model_embedding, 
+        search_query = messages[-1]["content"]
+        if config.albert_query_rewrite and len(messages) > 1:
+            search_query = await rewrite_query(aclient, config, messages)
+        chunks = None
+        if prefetch:
+            used = prefetch.query == search_query
+            metrics.counter(
+                "albert_search_prefetch_total", "Searches started early", used=str(used)
+            ).inc()
+            if used:
+                chunks = await prefetch.task
+        messages = await aclient.make_rag_prompt(
             messages=messages,
-            collections=collections,
-            limit=7
+            search_query=search_query,
+            chunks=chunks,
+            **get_search_params(config),
         )
         rag_chunks = aclient.last_chunks
     else:
@@ -77,12 +346,19 @@ def generate(
         ] + messages
 
     # Generate answer
-    answer = aclient.generate(model=model, messages=messages, **sampling_params)
+    fallback_model, hedge_after = await get_hedging_policy(config)
+    answer = await aclient.generate(
+        model=model,
+        messages=messages,
+        fallback_model=fallback_model,
+        hedge_after=hedge_after,
+        **sampling_params,
+    )
 
-    # Set the chunks used by the rag or empty list.
-    config.last_rag_chunks = rag_chunks
-
-    return answer.strip()
+    answer = answer.strip()
+    if cache_key:
+        answer_cache.set(cache_key, (answer, rag_chunks))
+    return answer, rag_chunks
 
 
 def get_all_public_collections(config: Config) -> dict:
@@ -129,18 +405,41 @@ def delete_collections_with_name(config: Config, collection_name: str) -> None:
 
 
 def flush_collections_with_name(config: Config, collection_name: str) -> None:
+    """
+    Empty the collections named `collection_name`. Each one is deleted in a single call, and
+    created again by get_or_create_collection_with_name on the next upload. If the API refuses
+    to delete a collection, its documents are deleted instead, FLUSH_CONCURRENCY at a time.
+    """
     api_key = config.albert_api_token
     url = os.path.join(config.albert_api_url, API_PREFIX_V1)
     aclient = AlbertApiClient(base_url=url, api_key=api_key)
     collections = aclient.fetch_collections().values()
     for collection in collections:
-        if collection["name"] == collection_name:
-            documents = aclient.fetch_documents(collection['id'])
-            for document in documents:
-                aclient.delete_document(collection['id'], document['id'])
+        if collection["name"] != collection_name:
+            continue
+        try:
+            aclient.delete_collection(collection["id"])
+            method = "collection"
+        except requests.HTTPError as err:
+            if is_failure(err):
+                raise
+            if err.response.status_code == 404:  # Already deleted
+                continue
+            logger.warning(
+                "Could not delete collection, deleting its documents",
+                collection_id=collection["id"],
+                status=err.response.status_code,
+            )
+            documents = aclient.fetch_documents(collection["id"])
+            delete = partial(aclient.delete_document, collection["id"])
+            with ThreadPoolExecutor(FLUSH_CONCURRENCY) as pool:
+                list(pool.map(delete, [document["id"] for document in documents]))  # raises
+            method = "documents"
+        metrics.counter("albert_flush_total", "Collections flushed", method=method).inc()
 
 
 def upload_file(config: Config, file: BytesIO, collection_id: str) -> dict:
+    """Upload a file in the collection, return the answer of the API (ids of the documents)"""
     api_key = config.albert_api_token
     url = os.path.join(config.albert_api_url, API_PREFIX_V1)
     aclient = AlbertApiClient(base_url=url, api_key=api_key)
@@ -154,13 +453,61 @@ def get_documents(config: Config, collection_id: str) -> list[dict]:
     return aclient.fetch_documents(collection_id)
 
 
+async def fetch_chunks(config: Config, refs: list[dict]) -> dict[str, str]:
+    """Contents of the chunks by id (see sources.chunk_ref), the ones not found are left out"""
+    url = os.path.join(config.albert_api_url, API_PREFIX_V1)
+    aclient = AlbertApiClient(base_url=url, api_key=config.albert_api_token)
+    async with aiohttp.ClientSession() as session:
+        results = await asyncio.gather(
+            *(aclient.fetch_chunk(session, ref["collection_id"], ref["id"]) for ref in refs),
+            return_exceptions=True,
+        )
+    contents = {}
+    for ref, result in zip(refs, results):
+        if isinstance(result, Exception):
+            logger.warning("Could not fetch chunk", chunk_id=ref["id"], error=str(result))
+        else:
+            contents[ref["id"]] = result["content"]
+    return contents
+
+
+def albert_latency(endpoint: str, **labels):
+    return metrics.histogram(
+        "albert_request_seconds", "Albert API latency", endpoint=endpoint, **labels
+    ).time()
+
+
+def chat_latency(model: str):
+    """Latency of the completions of a model that went through (cancelled ones are not counted)"""
+    return metrics.histogram(
+        "albert_request_seconds", "Albert API latency", endpoint="chat", model=model
+    )
+
+
+def get_openai_client(base_url: str, api_key: str) -> AsyncOpenAI:
+    """
+    One client per API, to reuse its connections. The connections are bound to the event loop:
+    when the bot is restarted with a new loop (see bot.main), a new client is created.
+    """
+    loop = asyncio.get_running_loop()
+    cached = _openai_clients.get((base_url, api_key))
+    if cached is None or cached[0] is not loop:
+        # The retries are made by utils.retry, which knows about the circuit breakers.
+        client = AsyncOpenAI(base_url=base_url, api_key=api_key, max_retries=0)
+        cached = _openai_clients[(base_url, api_key)] = (loop, client)
+    return cached[1]
+
+
 class AlbertApiClient:
     def __init__(self, base_url: str, api_key: str):
         self.base_url = base_url
         self.api_key = api_key
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
         self._last_chunks: list[dict] = []  # stores last sources used by a RAG generation.
 
+    @property
+    def client(self) -> AsyncOpenAI:
+        return get_openai_client(self.base_url, self.api_key)
+
     @property
     def last_chunks(self) -> list[dict]:
         return self._last_chunks
@@ -170,49 +517,120 @@ class AlbertApiClient:
         url = self.base_url
         headers = {"Authorization": f"Bearer {self.api_key}"}
         data = {"name": collection_name, "model": model_embedding, "type": "private"}
-        response = requests.post(f"{url}/collections", json=data, headers=headers)
-        log_and_raise_for_status(response)
+        with albert_breakers["collections"].guard() as timeout, albert_latency("collections"):
+            response = requests.post(
+                f"{url}/collections", json=data, headers=headers, timeout=timeout
+            )
+            log_and_raise_for_status(response)
         data = response.json()
         data["name"] = collection_name
         return data
     
+    @retry()
     def delete_collection(self, collection_id: str) -> None:
         """Call the DELETE /collections/{collection_id} endpoint of the Albert API"""
         url = self.base_url
         headers = {"Authorization": f"Bearer {self.api_key}"}
-        response = requests.delete(f"{url}/collections/{collection_id}", headers=headers)
-        log_and_raise_for_status(response)
+        with albert_breakers["collections"].guard() as timeout, albert_latency("collections"):
+            response = requests.delete(
+                f"{url}/collections/{collection_id}", headers=headers, timeout=timeout
+            )
+            log_and_raise_for_status(response)
     
+    @retry()
     def fetch_collections(self) -> dict:
         """Call the GET /collections endpoint of the Albert API"""
         url = self.base_url
         headers = {"Authorization": f"Bearer {self.api_key}"}
-        response = requests.get(f"{url}/collections", headers=headers)
-        log_and_raise_for_status(response)
+        with albert_breakers["collections"].guard() as timeout, albert_latency("collections"):
+            response = requests.get(f"{url}/collections", headers=headers, timeout=timeout)
+            log_and_raise_for_status(response)
         data = response.json()
         collections_by_id = {v["id"]: v for v in data["data"]}
         return collections_by_id
     
+    @retry()
     def delete_document(self, collection_id: str, document_id: str) -> None:
         """Call the DELETE /documents/{collection_id}/{document_id} endpoint of the Albert API"""
         url = self.base_url
         headers = {"Authorization": f"Bearer {self.api_key}"}
-        response = requests.delete(f"{url}/documents/{collection_id}/{document_id}", headers=headers)
-        log_and_raise_for_status(response)
-
-    def generate(self, model: str, messages: list[dict], **sampling_params) -> str:
-        result = self.client.chat.completions.create(
-            model=model, messages=messages, **sampling_params
-        )
+        with albert_breakers["collections"].guard() as timeout, albert_latency("documents"):
+            response = requests.delete(
+                f"{url}/documents/{collection_id}/{document_id}", headers=headers, timeout=timeout
+            )
+            log_and_raise_for_status(response)
+
+    @traced()
+    async def generate(
+        self,
+        model: str,
+        messages: list[dict],
+        fallback_model: str | None = None,
+        hedge_after: float | None = None,
+        **sampling_params,
+    ) -> str:
+        """
+        Generate a completion with `model`. If `fallback_model` is given and the completion
+        takes longer than `hedge_after` seconds, the same request is sent to the fallback model:
+        the first answer wins and the other request is cancelled.
+        """
+        if not fallback_model or hedge_after is None:
+            return await self._complete(model, messages, **sampling_params)
+
+        primary = asyncio.create_task(self._complete(model, messages, **sampling_params))
+        done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        metrics.counter("albert_hedge_total", "Hedged completions", result="fired").inc()
+        hedge = asyncio.create_task(self._complete(fallback_model, messages, **sampling_params))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = "fallback_won" if task is hedge else "primary_won"
+                        metrics.counter("albert_hedge_total", result=winner).inc()
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        # Both requests failed
+        metrics.counter("albert_hedge_total", result="failed").inc()
+        return primary.result()
+
+    @retry()
+    async def _complete(
+        self, model: str, messages: list[dict], endpoint: str = "chat", **sampling_params
+    ) -> str:
+        """
+        The short completions (`endpoint="rewrite"`) go through their own breaker and are not
+        observed, not to skew the timeout of the answers and the latency used to hedge.
+        """
+        start = time.perf_counter()
+        with albert_breakers[endpoint].guard() as timeout:
+            result = await self.client.chat.completions.create(
+                model=model, messages=messages, timeout=timeout, **sampling_params
+            )
+        if endpoint == "chat":
+            chat_latency(model).observe(time.perf_counter() - start)
         answer = result.choices[0].message.content
         return answer
 
-    def make_rag_prompt(self, 
+    async def make_rag_prompt(self, 
         model_embedding: str, 
         messages: list[dict],
         collections: list[str],
-        limit: int = 7
+        search_query: str | None = None,
+        chunks: list[dict] | None = None,
+        **search_params,
     ) -> list[dict]:
+        """
+        Put the most relevant chunks in the last message, unless `chunks` are already given.
+        The chunks are searched with `search_query` if given (a rewritten query), else with
+        the last message.
+        """
         messages = [
             {
                 "role": "system",
@@ -220,18 +638,110 @@ class AlbertApiClient:
             }
         ] + messages
         query = messages[-1]["content"]
-        chunks = self.semantic_search(model_embedding, query, limit, collections)
+        if chunks is None:
+            chunks = await self.search_chunks(
+                model_embedding, search_query or query, collections, **search_params
+            )
         self._last_chunks = chunks
         prompt = self.format_albert_template(query, chunks)
         messages[-1]["content"] = prompt
         return messages
 
-    def semantic_search(
+    async def search_chunks(
+        self,
+        model_embedding: str,
+        query: str,
+        collections: list[str],
+        limit: int = 7,
+        candidates: int | None = None,
+        **search_params,
+    ) -> list[dict]:
+        """
+        The `limit` most relevant chunks. With `candidates`, that many chunks are searched
+        and re-ranked locally (see rerank.py).
+        """
+        if not candidates or candidates <= limit:
+            return await self.semantic_search(
+                model_embedding, query, limit, collections, **search_params
+            )
+        chunks = await self.semantic_search(
+            model_embedding, query, candidates, collections, **search_params
+        )
+        with span("rerank", candidates=len(chunks)):
+            return await run_cpu(rerank, query, chunks, limit)
+
+    @traced()
+    async def semantic_search(
         self, 
         model: str, 
         query: str, 
         limit: int, 
-        collections: list[str]
+        collections: list[str],
+        fanout: int = 1,
+        deadline: float | None = None,
+        private_collections: list[str] = (),
+    ) -> list[dict]:
+        """
+        Search the `limit` chunks of the collections most similar to the query.
+
+        The collections are split in `fanout` groups searched concurrently, `limit` chunks by
+        group (see split_collections), and the results are merged by score. Once `deadline` seconds
+        have passed, the groups that have not answered are left out, if another one has.
+        """
+        loop = asyncio.get_running_loop()
+        end = loop.time() + deadline if deadline else None
+        chunks: list[dict] = []
+        errors: list[BaseException] = []
+        answered = 0
+        async with aiohttp.ClientSession() as session:
+            pending = {
+                asyncio.create_task(self._search(session, model, query, limit, group))
+                for group in split_collections(collections, fanout, private_collections)
+            }
+            try:
+                while pending:
+                    timeout = None if end is None else max(0.0, end - loop.time())
+                    done, pending = await asyncio.wait(
+                        pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if not done:
+                        if answered:
+                            break
+                        end = None  # Past the deadline, but nothing to answer with yet
+                    for task in done:
+                        if task.exception():
+                            errors.append(task.exception())
+                        else:
+                            answered += 1
+                            chunks.extend(task.result())
+            finally:
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        if not answered and errors:
+            raise errors[0]
+        if pending or errors:
+            metrics.counter(
+                "albert_search_partial_total", "Searches missing some collections"
+            ).inc()
+            logger.warning(
+                "Partial search results",
+                late=len(pending),
+                failed=len(errors),
+                error=str(errors[0]) if errors else None,
+            )
+        chunks.sort(key=lambda chunk: -chunk["score"])
+        return chunks[:limit]
+
+    @retry()
+    async def _search(
+        self,
+        session: aiohttp.ClientSession,
+        model: str,
+        query: str,
+        k: int,
+        collections: list[str],
     ) -> list[dict]:
         """Call the /search endpoint of the Albert API"""
         url = self.base_url
@@ -240,55 +750,67 @@ class AlbertApiClient:
             "prompt": query,
             "model": model,
             "collections": collections,
-            "k": limit,
+            "k": k,
         }
-        response = requests.post(f"{url}/search", headers=headers, json=params)
-        log_and_raise_for_status(response)
-        data = response.json()
-        chunks = [v["chunk"]for v in data["data"]]
-        return chunks
+        with albert_breakers["search"].guard() as timeout, albert_latency("search"):
+            async with session.post(
+                f"{url}/search",
+                headers=headers,
+                json=params,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as response:
+                await alog_and_raise_for_status(response)
+                data = await response.json()
+        return [{**v["chunk"], "score": v["score"]} for v in data["data"]]
     
     def upload_file(
         self, 
         file: BytesIO, 
         collection_id: str
-    ) -> list[dict]:
+    ) -> dict:
         """Call the /files endpoint of the Albert API"""
         url = self.base_url
         headers = {"Authorization": f"Bearer {self.api_key}"}
         files = {"file": (file.name, file.getvalue(), file.type)}
         data = {"request": '{"collection": "%s"}' % collection_id}
-        response = requests.post(f"{url}/files", data=data, files=files, headers=headers)
-        log_and_raise_for_status(response)
-
+        with albert_breakers["files"].guard() as timeout, albert_latency("files"):
+            response = requests.post(
+                f"{url}/files", data=data, files=files, headers=headers, timeout=timeout
+            )
+            log_and_raise_for_status(response)
+        return response.json()
+
+    @retry()
+    async def fetch_chunk(
+        self, session: aiohttp.ClientSession, collection_id: str, chunk_id: str
+    ) -> dict:
+        """Call the GET /chunks/{collection_id}/{chunk_id} endpoint of the Albert API"""
+        url = self.base_url
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        with albert_breakers["search"].guard() as timeout, albert_latency("chunks"):
+            async with session.get(
+                f"{url}/chunks/{collection_id}/{chunk_id}",
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as response:
+                await alog_and_raise_for_status(response)
+                return await response.json()
+
+    @retry()
     def fetch_documents(self, collection_id: str) -> list[dict]:
         """Call the /documents endpoint of the Albert API"""
         url = self.base_url
         headers = {"Authorization": f"Bearer {self.api_key}"}
-        response = requests.get(f"{url}/documents/{collection_id}", headers=headers)
-        log_and_raise_for_status(response)
+        with albert_breakers["collections"].guard() as timeout, albert_latency("documents"):
+            response = requests.get(
+                f"{url}/documents/{collection_id}", headers=headers, timeout=timeout
+            )
+            log_and_raise_for_status(response)
         return response.json()['data']
 
     def format_albert_template(self, query: str, chunks: list[dict]) -> str:
         # Template configuration
-        prompt_template = """Utilisez le contexte suivant comme votre base de connaissances, à l'intérieur des balises XML <context></context>.
-
-<context>
-{% for chunk in chunks %}
-id: {{chunk.id}}
-document: {{chunk.metadata.document_name}}
-content: {{chunk.content}} {% if not loop.last %}{{"\n"}}{% endif %}
-{% endfor %}
-</context>
-
-
-Lors de la réponse à l'utilisateur :
-- Si vous ne savez pas ou si vous n'êtes pas sûr, demandez une clarification.
-- Évitez de mentionner que vous avez obtenu les informations du contexte.
-
-Étant donné les sources d'informations du contexte, répondez à la question.
-Question : {{query}}
-"""
+        prompt_template = RAG_PROMPT_TEMPLATE
 
         conf = {
             "limit": len(chunks),
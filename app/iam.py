@@ -5,8 +5,11 @@ from collections import namedtuple
 from datetime import datetime, timedelta, timezone
 
 import aiohttp
+from matrix_bot.metrics import metrics
+from matrix_bot.tracing import traced
 
 from bot_msg import AlbertMsg
+from utils import retry
 
 UserRecord = namedtuple(
     "UserRecord",
@@ -30,19 +33,22 @@ class AsyncGristDocAPI:
 
     async def _request(self, method, endpoint, json_data=None):
         headers = {"Authorization": f"Bearer {self.api_key}"}
-        async with aiohttp.ClientSession() as session:
-            if method in ["GET"]:
-                data = {"params": json_data}
-            else:
-                headers["Content-Type"] = "application/json"
-                data = {"json": json_data}
-
-            async with session.request(
-                method, self.base_url + endpoint, headers=headers, **data
-            ) as response:
-                response.raise_for_status()
-                return await response.json()
-
+        latency = metrics.histogram("grist_request_seconds", "Grist API latency", method=method)
+        with latency.time():
+            async with aiohttp.ClientSession() as session:
+                if method in ["GET"]:
+                    data = {"params": json_data}
+                else:
+                    headers["Content-Type"] = "application/json"
+                    data = {"json": json_data}
+
+                async with session.request(
+                    method, self.base_url + endpoint, headers=headers, **data
+                ) as response:
+                    response.raise_for_status()
+                    return await response.json()
+
+    @retry()
     async def fetch_table(self, table_id, filters=None) -> list[UserRecord]:
         endpoint = f"/docs/{self.doc_id}/tables/{table_id}/records"
         data = {}
@@ -61,6 +67,7 @@ class AsyncGristDocAPI:
         result = await self._request("POST", endpoint, data)
         return result
 
+    @retry()
     async def update_records(self, table_id, records):
         endpoint = f"/docs/{self.doc_id}/tables/{table_id}/records"
         records = [r.copy() for r in records]
@@ -108,7 +115,11 @@ class TchapIam:
 
     async def _refresh(self):
         ttl = datetime.utcnow() - timedelta(seconds=self.REFRESH_DELTA)
-        if not self.last_refresh or self.last_refresh < ttl:
+        is_stale = not self.last_refresh or self.last_refresh < ttl
+        metrics.counter(
+            "grist_users_cache_total", "Users table lookups", result="miss" if is_stale else "hit"
+        ).inc()
+        if is_stale:
             # Build allowed users list
             users_table = await self.iam_client.fetch_table(
                 self.users_table_name, filters={"status": ["allowed"]}
@@ -128,6 +139,7 @@ class TchapIam:
             self.last_refresh = datetime.utcnow()
             print("User table (IAM) updated")
 
+    @traced()
     async def is_user_allowed(self, config, username, refresh=False) -> tuple[bool, str]:
         """Check if user is allowed to use the tchap bot:
         1. User should be in the whitelist, otherwise send user_not_allowed message
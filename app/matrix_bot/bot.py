@@ -4,13 +4,17 @@
 # SPDX-License-Identifier: MIT
 
 import asyncio
+import time
 
-from nio import SyncResponse
+from nio import MatrixRoom, RoomMessage, SyncResponse
 
 from .auth import AuthLogin, Credentials
 from .callbacks import Callbacks
 from .client import MatrixClient
 from .config import bot_lib_config, logger
+from .executor import cpu_executor, monitor_loop_lag
+from .metrics import log_metrics, metrics, serve_metrics
+from .sharding import ShardedDispatcher
 
 
 class MatrixBot:
@@ -23,16 +27,119 @@ class MatrixBot:
             AuthLogin(Credentials(homeserver=homeserver, username=username, password=password))
         )
         self.callbacks = Callbacks(self.matrix_client)
+        self._background_tasks: set[asyncio.Task] = set()
+        self.dispatcher: ShardedDispatcher | None = None
+
+    def use_shard_workers(self, setup: str, n_workers: int = bot_lib_config.shard_workers):
+        """
+        Handle the room events in `n_workers` processes instead of the sync process.
+        `setup` is the "module:function" path of a function registering the callbacks of a worker
+        on the given Callbacks, as done on `self.callbacks`.
+        """
+        self.dispatcher = ShardedDispatcher(self.matrix_client, n_workers, setup)
 
     async def main(self):
+        metrics_runner = None
+        if bot_lib_config.metrics_port:
+            metrics_runner = await serve_metrics(bot_lib_config.metrics_port)
+        try:
+            await self._main()
+        finally:
+            # Free the port: the bot may be run again in the same process after a crash
+            if metrics_runner:
+                await metrics_runner.cleanup()
+
+    async def _main(self):
+        timings = {}
+        start = step = time.perf_counter()
+
+        def record(phase: str):
+            nonlocal step
+            now = time.perf_counter()
+            timings[phase] = round(now - step, 3)
+            metrics.gauge("bot_startup_seconds", "Duration of the startup phases", phase=phase).set(
+                now - step
+            )
+            step = now
+
+        self._start_background_task(monitor_loop_lag())
+        if bot_lib_config.metrics_log_interval:
+            self._start_background_task(log_metrics(bot_lib_config.metrics_log_interval))
         await self.matrix_client.automatic_login()
-        sync = await self.matrix_client.sync(timeout=bot_lib_config.timeout, full_state=True)  # Ignore prior messages
+        # Warm restart: the sync token stored by nio (or kept from the previous run) is used,
+        # so the homeserver only sends what happened while the bot was down.
+        # The full state is still needed: nio does not persist the rooms state.
+        since = self.matrix_client.next_batch or self.matrix_client.loaded_sync_token
+        record("login")
+        sync_filter = await self.matrix_client.get_sync_filter()
+        record("sync_filter")
+        sync = await self.matrix_client.sync(
+            timeout=bot_lib_config.timeout, full_state=True, sync_filter=sync_filter
+        )
+        record("initial_sync")
         self.print_sync_response(sync)
-        await self.callbacks.setup_callbacks()
+        if self.dispatcher:
+            self.dispatcher.start()
+        await self.callbacks.setup_callbacks(self.dispatcher)
         for action in self.callbacks.startup:
             for room_id in self.matrix_client.rooms:
                 await action(room_id)
-        await self.matrix_client.sync_forever(timeout=3000, full_state=True)
+        for func, interval in self.callbacks.periodic:
+            self._start_background_task(self._run_periodic(func, interval))
+        record("callbacks")
+
+        if since and isinstance(sync, SyncResponse) and bot_lib_config.catch_up_policy != "skip":
+            # Not awaited: the sync loop starts while the missed messages are being answered.
+            self._start_background_task(self.catch_up(sync))
+
+        timings["total"] = round(time.perf_counter() - start, 3)
+        logger.info("Bot started", restart="warm" if since else "cold", **timings)
+
+        # The full state has been loaded by the first sync, the next ones only get the changes.
+        await self.matrix_client.sync_forever(timeout=3000, sync_filter=sync_filter)
+
+    def _start_background_task(self, coro):
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _run_periodic(self, func, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await func(self.matrix_client)
+            except Exception as periodic_error:
+                logger.error("Periodic task failed", func=func.__name__, error=str(periodic_error))
+
+    async def catch_up(self, sync: SyncResponse):
+        """Handle the events received while the bot was down, according to the catch-up policy"""
+        min_timestamp = (time.time() - bot_lib_config.catch_up_max_age) * 1000
+        for room_id, join_info in sync.rooms.join.items():
+            room = self.matrix_client.rooms.get(room_id)
+            events = [
+                event
+                for event in join_info.timeline.events
+                if getattr(event, "sender", None) != self.matrix_client.user_id
+                and getattr(event, "server_timestamp", 0) >= min_timestamp
+            ]
+            if not room or not events:
+                continue
+
+            messages = [event for event in events if isinstance(event, RoomMessage)]
+            if bot_lib_config.catch_up_policy == "summarise" and messages:
+                for func in self.callbacks.catch_up:
+                    await func(room=room, events=messages, matrix_client=self.matrix_client)
+                events = [e for e in events if not isinstance(e, RoomMessage)] + messages[-1:]
+
+            metrics.counter("bot_catch_up_events_total", "Events handled after a restart").inc(
+                len(events)
+            )
+            await self._dispatch(room, events)
+
+    async def _dispatch(self, room: MatrixRoom, events: list):
+        for event in events:
+            for callback in self.matrix_client.event_callbacks:
+                await callback.execute(event, room)
 
     def print_sync_response(self, sync):
         if not isinstance(sync, SyncResponse):
@@ -53,4 +160,9 @@ class MatrixBot:
 
     def run(self):
         """Runs the bot."""
-        asyncio.run(self.main())
+        try:
+            asyncio.run(self.main())
+        finally:
+            if self.dispatcher:
+                self.dispatcher.stop()
+            cpu_executor.shutdown()
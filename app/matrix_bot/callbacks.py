@@ -2,6 +2,7 @@
 # SPDX-FileCopyrightText: 2023 Pôle d'Expertise de la Régulation Numérique <contact.peren@finances.gouv.fr>
 #
 # SPDX-License-Identifier: MIT
+import time
 import traceback
 from functools import wraps
 
@@ -24,6 +25,8 @@ from .eventparser import (
     EventParser,
     MessageEventParser,
 )
+from .metrics import metrics
+from .tracing import discard_trace, start_trace
 
 
 def properly_fail(matrix_client, error_msg=AlbertMsg.failed):
@@ -66,6 +69,8 @@ class Callbacks:
     def __init__(self, matrix_client: MatrixClient):
         self.matrix_client = matrix_client
         self.startup: list = []
+        self.catch_up: list = []
+        self.periodic: list[tuple] = []
         self.client_callback: list = []
 
     def register_on_custom_event(self, func, onEvent: Event, feature: dict):
@@ -75,6 +80,14 @@ class Callbacks:
             if not isinstance(event, onEvent):
                 raise EventNotConcerned
 
+            with start_trace(feature["name"], event.event_id, room.room_id) as trace:
+                try:
+                    await handle(room, event)
+                except EventNotConcerned:
+                    discard_trace(trace)
+                    raise
+
+        async def handle(room, event):
             if onEvent == RoomMessageText:
                 ep = MessageEventParser(
                     room=room, event=event, matrix_client=self.matrix_client, log_usage=True
@@ -86,7 +99,19 @@ class Callbacks:
                     room=room, event=event, matrix_client=self.matrix_client, log_usage=True
                 )
 
-            await func(ep=ep, matrix_client=self.matrix_client)
+            handler_seconds = metrics.histogram(
+                "bot_handler_seconds", "Duration of the feature handlers", feature=feature["name"]
+            )
+            start = time.perf_counter()
+            try:
+                await func(ep=ep, matrix_client=self.matrix_client)
+            except EventNotConcerned:
+                raise  # Not handled: not timed
+            except Exception:
+                handler_seconds.observe(time.perf_counter() - start)
+                raise
+            handler_seconds.observe(time.perf_counter() - start)
+
         self.client_callback.append((wrapped_func, onEvent))
 
     def register_on_reaction_event(self, func):
@@ -101,16 +126,39 @@ class Callbacks:
     def register_on_startup(self, func):
         self.startup.append(func)
 
-    async def setup_callbacks(self):
-        """Add callbacks to async_client"""
+    def register_on_catch_up(self, func):
+        """
+        With the "summarise" catch-up policy, `func(room, events, matrix_client)` is called with the
+        messages a room received while the bot was down, before its last message is handled.
+        """
+        self.catch_up.append(func)
+
+    def register_periodic(self, func, interval: float):
+        """
+        `func(matrix_client)` is called every `interval` seconds while the bot runs,
+        in the sync process (not in the shard workers).
+        """
+        self.periodic.append((func, interval))
+
+    async def setup_callbacks(self, dispatcher=None):
+        """
+        Add callbacks to async_client.
+        With a ShardedDispatcher, the room events are forwarded to the shard workers,
+        which run the custom callbacks themselves.
+        """
         if bot_lib_config.join_on_invite:
             self.matrix_client.add_event_callback(self.invite_callback, InviteMemberEvent)
 
         self.matrix_client.add_event_callback(self.decryption_failure, MegolmEvent)
+        if dispatcher:
+            room_events = {event for _, event in self.client_callback}
+            room_events = tuple(e for e in room_events if not issubclass(e, ToDeviceEvent))
+            self.matrix_client.add_event_callback(dispatcher.forward, room_events)
+
         for function, event in self.client_callback:
             if issubclass(event, ToDeviceEvent):
                 self.matrix_client.add_to_device_callback(function, event)
-            else:
+            elif not dispatcher:
                 self.matrix_client.add_event_callback(function, event)
 
     async def invite_callback(self, room: MatrixRoom, event: InviteMemberEvent):
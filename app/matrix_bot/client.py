@@ -4,6 +4,7 @@
 # SPDX-License-Identifier: MIT
 import mimetypes
 import os
+import time
 from html.parser import HTMLParser
 from pathlib import Path
 from typing import Any, Dict, Optional, Tuple, Union
@@ -15,10 +16,14 @@ from nio import (
     AsyncClient,
     AsyncClientConfig,
     ErrorResponse,
+    KeysQueryResponse,
     RemoteProtocolError,
+    Response,
     RoomMessage,
     RoomSendResponse,
+    SyncResponse,
     UploadError,
+    UploadFilterResponse,
 )
 from nio.exceptions import OlmUnverifiedDeviceError
 from nio.responses import UploadResponse
@@ -26,7 +31,13 @@ from PIL import Image
 
 from .auth import AuthLogin
 from .config import bot_lib_config, logger
+from .device_trust import DeviceTrustCache
+from .executor import run_cpu
+from .metrics import metrics
 from .room_utils import room_is_direct_message
+from .scheduler import SendScheduler
+from .tracing import span, traced
+from .typing_manager import TypingManager
 
 
 def check_valid_homeserver(homeserver: str):
@@ -44,6 +55,36 @@ def check_valid_homeserver(homeserver: str):
         ) from http_error
 
 
+def build_sync_filter(timeline_types: list[str], timeline_limit: int) -> dict:
+    """
+    Sync filter for a bot: members are lazy-loaded (the homeserver still sends the room summary,
+    and nio fetches the full member list itself before encrypting), only the given event types
+    are kept in the timeline, and the presence, typing and receipts updates are dropped.
+    """
+    return {
+        "room": {
+            "state": {"lazy_load_members": True},
+            "timeline": {
+                "limit": timeline_limit,
+                "types": timeline_types,
+                "lazy_load_members": True,
+            },
+            "ephemeral": {"not_types": ["*"]},
+            "account_data": {"not_types": ["*"]},
+        },
+        "presence": {"not_types": ["*"]},
+        "account_data": {"not_types": ["*"]},
+    }
+
+
+def render_markdown(message: str) -> str:
+    """Render a markdown message to the HTML sent to the rooms"""
+    message = markdown.markdown(message, extensions=["fenced_code", "nl2br"])
+    if bot_lib_config.message_prefix:
+        message = bot_lib_config.message_prefix + "\n\n" + message
+    return message
+
+
 def extract_text_from_html(html: str) -> str:
     """This is used to get a rough non-HTML fallback version to put in `body`"""
 
@@ -71,7 +112,19 @@ class MatrixClient(AsyncClient):
         check_valid_homeserver(self.auth.credentials.homeserver)
         self.matrix_config = bot_lib_config
         self.matrix_config.store_path.mkdir(mode=0o750, exist_ok=True, parents=True)
+        self.send_scheduler = SendScheduler(
+            rate=self.matrix_config.send_rate,
+            burst=self.matrix_config.send_burst,
+            max_retries=self.matrix_config.send_max_retries,
+        )
+        self.typing_manager = TypingManager(
+            self._queue_typing,
+            timeout=self.matrix_config.typing_timeout,
+            max_duration=self.matrix_config.typing_max_duration,
+        )
+        self.device_trust = DeviceTrustCache()
         client_config = AsyncClientConfig(
+            # Rate limits are handled by the send scheduler, which pauses every room at once.
             max_limit_exceeded=0,
             max_timeouts=10,
             store_sync_tokens=True,
@@ -103,11 +156,27 @@ class MatrixClient(AsyncClient):
                 raise RemoteProtocolError(str(login_response))
             self.auth.device_id = login_response.device_id
             self.auth.access_token = login_response.access_token
-            self.auth.write_session_file()
+            await run_cpu(self.auth.write_session_file)  # PBKDF2 key derivation
 
         if self.should_upload_keys:
             await self.keys_upload()
 
+    async def get_sync_filter(self) -> str | dict | None:
+        """
+        Upload the sync filter of the bot and return its id.
+        Fall back to the inline filter if the upload fails, return None if filtering is disabled.
+        """
+        if not self.matrix_config.sync_filter_enabled:
+            return None
+        sync_filter = build_sync_filter(
+            self.matrix_config.sync_timeline_types, self.matrix_config.sync_timeline_limit
+        )
+        response = await self.upload_filter(**sync_filter)
+        if isinstance(response, UploadFilterResponse):
+            return response.filter_id
+        logger.warning("Failed to upload the sync filter, sending it inline", error=str(response))
+        return sync_filter
+
     def get_non_private_rooms(self):
         return {
             room_id: room
@@ -121,6 +190,7 @@ class MatrixClient(AsyncClient):
             return None
         return res.displayname
 
+    @traced()
     async def _send_room(
         self,
         room_id: str,
@@ -168,46 +238,113 @@ class MatrixClient(AsyncClient):
         if thread_root and reply_to:
             content["m.relates_to"]["is_falling_back"] = True
 
+        res = await self.send_scheduler.send(
+            room_id,
+            lambda: self._room_send_blacklisting_unverified(
+                room_id, content, message_type, ignore_unverified_devices
+            ),
+        )
+        if isinstance(res, RoomSendResponse):
+            return res.event_id
+        return None
+
+    async def _room_send_blacklisting_unverified(
+        self,
+        room_id: str,
+        content: dict,
+        message_type: str,
+        ignore_unverified_devices: Optional[bool],
+    ):
+        ignore_unverified_devices = (
+            ignore_unverified_devices or self.matrix_config.ignore_unverified_devices
+        )
+        if not ignore_unverified_devices and self.olm and room_id in self.encrypted_rooms:
+            # Fast path: the trust decision is only taken again after a device list change
+            self._log_blacklisted(self.device_trust.resolve(self.olm, self.rooms[room_id].users))
+
         try:
-            res = await self.room_send(
+            return await self.room_send(
                 room_id=room_id,
                 message_type=message_type,
                 content=content,
-                ignore_unverified_devices=ignore_unverified_devices
-                or self.matrix_config.ignore_unverified_devices,
+                ignore_unverified_devices=ignore_unverified_devices,
             )
-            if isinstance(res, RoomSendResponse):
-                return res.event_id
         except OlmUnverifiedDeviceError:
+            # Slow path: some devices were discovered while sending (keys query)
+            metrics.counter(
+                "matrix_device_trust_slow_path_total", "Sends that raised OlmUnverifiedDeviceError"
+            ).inc()
             logger.info(
                 "Message could not be sent. "
                 "Set ignore_unverified_devices = True to allow sending to unverified devices."
             )
-            logger.info("Automatically blacklisting the following devices:")
-            for user in self.rooms[room_id].users:
-                unverified: list[str] = []
-                assert self.olm
-                for device_id, device in self.olm.device_store[user].items():
-                    if not (
-                        self.olm.is_device_verified(device)
-                        or self.olm.is_device_blacklisted(device)
-                    ):
-                        self.olm.blacklist_device(device)
-                        unverified.append(device_id)
-                if len(unverified) > 0:
-                    logger.info(f"\tUser {user}: {', '.join(unverified)}")
-
-            res = await self.room_send(
+            assert self.olm
+            users = self.rooms[room_id].users
+            self.device_trust.invalidate(users)
+            self._log_blacklisted(self.device_trust.resolve(self.olm, users))
+
+            return await self.room_send(
                 room_id=room_id,
                 message_type=message_type,
                 content=content,
-                ignore_unverified_devices=ignore_unverified_devices
-                or self.matrix_config.ignore_unverified_devices,
+                ignore_unverified_devices=ignore_unverified_devices,
             )
-            if isinstance(res, RoomSendResponse):
-                return res.event_id
 
-        return None
+    @staticmethod
+    def _log_blacklisted(blacklisted: dict[str, list[str]]):
+        if not blacklisted:
+            return
+        logger.info("Automatically blacklisting the following devices:")
+        for user, device_ids in blacklisted.items():
+            logger.info(f"\tUser {user}: {', '.join(device_ids)}")
+
+    async def receive_response(self, response: Response) -> None:
+        start = time.perf_counter()
+        await super().receive_response(response)
+        if isinstance(response, SyncResponse):
+            await self._observe_sync(response, time.perf_counter() - start)
+            self.device_trust.invalidate(response.device_list.changed)
+            self.device_trust.invalidate(response.device_list.left)
+        elif isinstance(response, KeysQueryResponse):
+            self.device_trust.invalidate(response.changed)
+
+    async def _observe_sync(self, response: SyncResponse, processing_time: float):
+        sync_mode = "filtered" if self.matrix_config.sync_filter_enabled else "unfiltered"
+        metrics.histogram(
+            "matrix_sync_processing_seconds", "Time spent by nio to process a sync", mode=sync_mode
+        ).observe(processing_time)
+        if response.transport_response:
+            # The body has already been read to be parsed, read() returns the buffered bytes.
+            body = await response.transport_response.read()
+            metrics.histogram(
+                "matrix_sync_payload_bytes",
+                "Size of the sync responses",
+                buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8),
+                mode=sync_mode,
+            ).observe(len(body))
+        n_events = sum(
+            len(room.timeline.events) + len(room.state) for room in response.rooms.join.values()
+        )
+        metrics.counter("matrix_sync_events_total", "Room events received", mode=sync_mode).inc(
+            n_events
+        )
+
+    async def room_typing(self, room_id: str, typing_state: bool = True, timeout: int = 30000):
+        """
+        Set the typing state of the bot in a room.
+        Only the state changes reach the homeserver, see TypingManager. The timeout is
+        the one of the bot config: the notification is refreshed as long as the bot types.
+        """
+        self.typing_manager.set_typing(room_id, typing_state)
+
+    def _queue_typing(self, room_id: str, typing_state: bool, timeout: int):
+        """
+        Queue a typing notification in the send queue of the room.
+        It is not awaited: the notification is sent when the previous events of the room are.
+        """
+        self.send_scheduler.typing(
+            room_id, lambda: AsyncClient.room_typing(self, room_id, typing_state, timeout)
+        )
 
     async def send_text_message(
         self,
@@ -314,13 +451,11 @@ class MatrixClient(AsyncClient):
             The event id of the message acting as a thread root for the message.
         """
 
-        message = markdown.markdown(message, extensions=["fenced_code", "nl2br"])
-        if bot_lib_config.message_prefix:
-            message = bot_lib_config.message_prefix + "\n\n" + message
-
+        with span("render_markdown"):
+            html = await run_cpu(render_markdown, message)
         return await self.send_html_message(
             room_id=room_id,
-            message=message,
+            message=html,
             msgtype=msgtype,
             reply_to=reply_to,
             thread_root=thread_root,
@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: MIT
 import logging
 from pathlib import Path
+from typing import Literal
 
 import structlog
 from nio.crypto import ENCRYPTION_ENABLED
@@ -38,6 +39,70 @@ class BotLibConfig(BaseSettings):
         description="Salt to store your session credentials. Should not change between two runs",
     )
     message_prefix: str = Field(default="", description="Prefix to add at the beginning of the bot messages")
+    send_rate: float = Field(
+        default=5.0, description="Sustained number of events per second the bot is allowed to send"
+    )
+    send_burst: int = Field(default=10, description="Number of events the bot can send in a burst")
+    send_max_retries: int = Field(
+        default=5, description="How many times an event is re-sent after a M_LIMIT_EXCEEDED error"
+    )
+    cpu_executor: Literal["thread", "process", "none"] = Field(
+        default="thread",
+        description="Where the CPU-bound steps (attachment decryption, markdown rendering, "
+        "session key derivation) run: thread pool, process pool, or inline on the event loop",
+    )
+    cpu_workers: int = Field(
+        default=0, description="Size of the CPU executor pool, 0 for the executor default"
+    )
+    shard_workers: int = Field(
+        default=0,
+        description="Number of worker processes handling the events, rooms being dispatched by "
+        "hash of their id. With 0, the events are handled in the process that syncs",
+    )
+    metrics_port: int = Field(
+        default=0, description="Port of the prometheus /metrics endpoint, 0 to disable it"
+    )
+    metrics_log_interval: int = Field(
+        default=0, description="Log a summary of the metrics every this many seconds, 0 to disable"
+    )
+    trace_file: Path | None = Field(
+        default=None,
+        description="File where the traces of the handled events are appended, "
+        "in the zipkin v2 JSON format (one array of spans per line)",
+    )
+    catch_up_policy: Literal["skip", "answer", "summarise"] = Field(
+        default="skip",
+        description="What to do with the messages received while the bot was down: skip them, "
+        "answer all of them, or summarise them in the room and only answer its last message",
+    )
+    catch_up_max_age: int = Field(
+        default=3600, description="Messages older than this many seconds are never caught up"
+    )
+    sync_filter_enabled: bool = Field(
+        default=True,
+        description="Sync with a server-side filter: lazy-loaded members, "
+        "only the event types handled by the bot, no presence/typing/receipts",
+    )
+    sync_timeline_limit: int = Field(
+        default=20, description="Max number of timeline events per room in a filtered sync"
+    )
+    sync_timeline_types: list[str] = Field(
+        default=[
+            "m.room.message",
+            "m.room.encrypted",
+            "m.room.member",
+            "m.room.encryption",
+            "m.room.power_levels",
+            "m.reaction",
+        ],
+        description="Timeline event types kept by the sync filter",
+    )
+    typing_timeout: int = Field(
+        default=30_000, description="Lifetime of a typing notification, in milliseconds"
+    )
+    typing_max_duration: int = Field(
+        default=600, description="Stop refreshing a typing notification after this many seconds"
+    )
     model_config = SettingsConfigDict(env_file=Path(".matrix_bot_env"))
 
 
@@ -0,0 +1,45 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+from typing import Iterable
+
+from .metrics import metrics
+
+
+class DeviceTrustCache:
+    """
+    Remember the users whose unverified devices have already been blacklisted.
+
+    A user is resolved once, then skipped until a device list change of this user is seen
+    in a sync (`device_lists.changed`/`left`) or in a keys query answer.
+    """
+
+    def __init__(self):
+        self._resolved_users: set[str] = set()
+
+    def invalidate(self, users: Iterable[str]) -> None:
+        for user in users:
+            if user in self._resolved_users:
+                self._resolved_users.discard(user)
+                metrics.counter(
+                    "matrix_device_trust_invalidations_total", "Device list changes of known users"
+                ).inc()
+
+    def resolve(self, olm, users: Iterable[str]) -> dict[str, list[str]]:
+        """
+        Blacklist the unverified devices of the users that are not resolved yet.
+        Return the blacklisted device ids by user.
+        """
+        blacklisted: dict[str, list[str]] = {}
+        for user in users:
+            if user in self._resolved_users:
+                metrics.counter("matrix_device_trust_cache_total", result="hit").inc()
+                continue
+            metrics.counter("matrix_device_trust_cache_total", result="miss").inc()
+            for device_id, device in olm.device_store[user].items():
+                if not (olm.is_device_verified(device) or olm.is_device_blacklisted(device)):
+                    olm.blacklist_device(device)
+                    blacklisted.setdefault(user, []).append(device_id)
+            self._resolved_users.add(user)
+        return blacklisted
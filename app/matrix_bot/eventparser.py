@@ -95,11 +95,11 @@ class MessageEventParser(EventParser):
         :raise EventNotConcerned: if the current event is not concerned by the command.
         """
         commands = [commands] if isinstance(commands, str) else commands
-        body = self.event.body.strip()
+        body = self.body_without_reply_fallback()
         user_command = body.split()
         command = [commands[0]] + user_command[1:]
 
-        if not any([f"{prefix}{c}" == user_command[0] for c in commands]):
+        if not user_command or not any([f"{prefix}{c}" == user_command[0] for c in commands]):
             raise EventNotConcerned
 
         if self.log_usage:
@@ -109,8 +109,21 @@ class MessageEventParser(EventParser):
 
         self.command = command
 
+    def body_without_reply_fallback(self) -> str:
+        """
+        The body of a reply starts with the quote of the message replied to ("> <@user> ..."),
+        to remove so that a command can be sent in reply to a message.
+        """
+        body = self.event.body.strip()
+        if body.startswith("> <@"):
+            lines = body.splitlines()
+            while lines and lines[0].startswith(">"):
+                lines.pop(0)
+            body = "\n".join(lines).strip()
+        return body
+
     def is_command(self, prefix: str) -> bool:
-        text = self.event.body.strip()
+        text = self.body_without_reply_fallback()
         return text.startswith(prefix) and len(text) > 1
 
     def get_command(self) -> list[str] | None:
@@ -0,0 +1,82 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Executor for the CPU-bound steps (attachment decryption, session key derivation, markdown
+rendering), so that they don't stall the event loop while it has syncs and sends to serve.
+
+- "thread": a thread pool; enough for the C extensions that release the GIL (AES, PBKDF2),
+  and the GIL switch interval still lets the loop run during pure python work.
+- "process": a process pool; the functions and their arguments must be picklable.
+- "none": run inline on the loop, as before.
+"""
+
+import asyncio
+import functools
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Literal, TypeVar
+
+from .config import bot_lib_config, logger
+from .metrics import metrics
+
+T = TypeVar("T")
+
+
+class CpuExecutor:
+    def __init__(self, kind: Literal["thread", "process", "none"], max_workers: int | None = None):
+        self.kind = kind
+        self.max_workers = max_workers
+        self._executor: Executor | None = None
+
+    @property
+    def executor(self) -> Executor | None:
+        if self._executor is None and self.kind == "thread":
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="matrix-cpu")
+        elif self._executor is None and self.kind == "process":
+            self._executor = ProcessPoolExecutor(
+                self.max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        name = getattr(func, "__name__", type(func).__name__)
+        with metrics.histogram(
+            "cpu_task_seconds", "Duration of the offloaded CPU-bound steps", func=name
+        ).time():
+            if self.kind == "none":
+                return func(*args, **kwargs)
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs)
+            )
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+cpu_executor = CpuExecutor(bot_lib_config.cpu_executor, bot_lib_config.cpu_workers or None)
+
+
+async def run_cpu(func: Callable[..., T], *args, **kwargs) -> T:
+    """Run a CPU-bound function out of the event loop, with the configured executor"""
+    return await cpu_executor.run(func, *args, **kwargs)
+
+
+async def monitor_loop_lag(interval: float = 0.5, warn_threshold: float = 0.2) -> None:
+    """
+    Measure how late the loop wakes up from a sleep: it's the time any callback or
+    coroutine would have waited because something was hogging the loop.
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - start - interval)
+        metrics.histogram(
+            "event_loop_lag_seconds", "Delay of the event loop in waking up a task"
+        ).observe(lag)
+        if lag > warn_threshold:
+            logger.warning("Event loop lagging", lag=round(lag, 3))
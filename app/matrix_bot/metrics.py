@@ -0,0 +1,190 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+
+from .config import logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+    """A monotonically increasing value."""
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Gauge:
+    """A value that can go up and down (queue depth, in-flight requests...)."""
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets, following the prometheus semantics."""
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        """Observe the time spent in the with block, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q: float) -> float | None:
+        """Estimate the q-quantile by linear interpolation inside the matching bucket.
+        Returns None while no value has been observed."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for upper, n in zip(self.buckets, self.counts):
+            if n and seen + n >= rank:
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = upper
+        # The quantile lies in the +Inf bucket: the best we can say is the last bound.
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """
+    In-process store of the bot metrics. Metrics are identified by a name and optional labels,
+    and created on first access so that call sites don't need any declaration.
+    """
+
+    def __init__(self):
+        self._metrics: dict[tuple[str, tuple], Counter | Gauge | Histogram] = {}
+        self._help: dict[str, str] = {}
+
+    def _get(self, factory, name: str, help: str, labels: dict):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = factory()
+            if help:
+                self._help[name] = help
+        return metric
+
+    def counter(self, name: str, help: str = "", **labels) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str = "", **labels) -> Gauge:
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(
+        self, name: str, help: str = "", buckets: tuple[float, ...] = DEFAULT_BUCKETS, **labels
+    ) -> Histogram:
+        return self._get(lambda: Histogram(buckets), name, help, labels)
+
+    def collect(self):
+        """Yield (name, labels, metric) for every registered metric"""
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda x: x[0]):
+            yield name, dict(labels), metric
+
+    def render_prometheus(self) -> str:
+        """Render the metrics in the prometheus text exposition format"""
+        lines = []
+        seen = set()
+        for name, labels, metric in self.collect():
+            if name not in seen:
+                seen.add(name)
+                kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+            if isinstance(metric, Histogram):
+                cumulated = 0
+                for bound, n in zip(metric.buckets + (float("inf"),), metric.counts):
+                    cumulated += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_labels({**labels, 'le': le})} {cumulated}")
+                lines.append(f"{name}_sum{_labels(labels)} {metric.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {metric.count}")
+            else:
+                lines.append(f"{name}{_labels(labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """Compact view of the metrics for the logs: values, and count/p50/p95 of histograms"""
+        result = {}
+        for name, labels, metric in self.collect():
+            key = name + _labels(labels)
+            if isinstance(metric, Histogram):
+                if metric.count:
+                    result[key] = {
+                        "count": metric.count,
+                        "p50": round(metric.quantile(0.5), 3),
+                        "p95": round(metric.quantile(0.95), 3),
+                    }
+            else:
+                result[key] = metric.value
+        return result
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+metrics = MetricsRegistry()
+
+
+async def serve_metrics(port: int, host: str = "0.0.0.0") -> web.AppRunner:
+    """Expose the metrics on http://host:port/metrics, for prometheus to scrape"""
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics exposed", url=f"http://{host}:{port}/metrics")
+    return runner
+
+
+async def log_metrics(interval: float, **context) -> None:
+    """Periodically dump the metrics summary in the logs"""
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("Metrics", **context, metrics=metrics.summary())
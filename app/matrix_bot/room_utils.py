@@ -15,4 +15,6 @@ def room_is_direct_message(room: MatrixRoom) -> bool:
     """Returns True if the room is a direct message room"""
     # @DEBUG: If full_state is false whein initializing the matrix client,
     # the romm mebrers can be empty here event if the room is not.
-    return len(room.users) == 2 or len(room.users) == 0
+    # With lazy-loaded members, room.users only holds the members seen so far: member_count
+    # relies on the room summary sent by the homeserver (and falls back to room.users).
+    return room.member_count == 2 or room.member_count == 0
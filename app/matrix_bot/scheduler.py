@@ -0,0 +1,158 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+from nio import ErrorResponse
+
+from .config import logger
+from .metrics import metrics
+
+
+class TokenBucket:
+    """
+    Global rate limiter shared by all the rooms.
+    `pause` blocks every acquirer, it is used when the homeserver tells us to slow down.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def pause(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self, cost: float = 1) -> None:
+        while True:
+            now = time.monotonic()
+            if self.blocked_until > now:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return
+            await asyncio.sleep((cost - self.tokens) / self.rate)
+
+
+@dataclass
+class _Job:
+    send: Callable[[], Awaitable[Any]]
+    future: asyncio.Future | None = None
+    is_typing: bool = False
+    submitted_at: float = field(default_factory=time.perf_counter)
+
+
+def _retry_after(response) -> float | None:
+    """Return the delay (in seconds) asked by the homeserver if the response is a rate limit"""
+    if isinstance(response, ErrorResponse) and response.status_code in ("M_LIMIT_EXCEEDED", 429):
+        return (response.retry_after_ms or 5000) / 1000
+    return None
+
+
+class SendScheduler:
+    """
+    Serialize the outgoing requests of the bot:
+    - one FIFO per room, so that the messages of a room are sent in order,
+    - a global token bucket, so that bursts do not hit the homeserver rate limit,
+    - M_LIMIT_EXCEEDED responses are retried after `retry_after_ms` (and pause every room),
+    - a typing notification still waiting in a room queue is replaced by the newer one.
+    """
+
+    def __init__(self, rate: float, burst: int, max_retries: int):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self._queues: dict[str, deque[_Job]] = {}
+        self._workers: dict[str, asyncio.Task] = {}
+        self._pending_typing: dict[str, _Job] = {}
+        self._queue_depth = metrics.gauge(
+            "matrix_send_queue_depth", "Number of requests waiting in the send queues"
+        )
+
+    async def send(self, room_id: str, send: Callable[[], Awaitable[Any]]) -> Any:
+        """Queue `send` after the other requests of the room and return its result"""
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(room_id, _Job(send=send, future=future))
+        return await future
+
+    def typing(self, room_id: str, send: Callable[[], Awaitable[Any]]) -> None:
+        """Queue a typing notification without waiting for it to be sent"""
+        pending = self._pending_typing.get(room_id)
+        if pending:
+            pending.send = send
+            metrics.counter("matrix_typing_coalesced_total", "Typing notifications coalesced").inc()
+            return
+        job = _Job(send=send, is_typing=True)
+        self._pending_typing[room_id] = job
+        self._enqueue(room_id, job)
+
+    def _enqueue(self, room_id: str, job: _Job) -> None:
+        self._queues.setdefault(room_id, deque()).append(job)
+        self._queue_depth.inc()
+        if room_id not in self._workers:
+            self._workers[room_id] = asyncio.create_task(self._run_room(room_id))
+
+    async def _run_room(self, room_id: str) -> None:
+        queue = self._queues[room_id]
+        try:
+            while queue:
+                job = queue.popleft()
+                self._queue_depth.dec()
+                if job.is_typing:
+                    self._pending_typing.pop(room_id, None)
+                await self._execute(room_id, job)
+        finally:
+            # No await between the last check of the queue and the cleanup:
+            # a job enqueued meanwhile would have found this worker.
+            for job in queue:
+                self._queue_depth.dec()
+                if job.future and not job.future.done():
+                    job.future.cancel()
+            del self._queues[room_id]
+            del self._workers[room_id]
+            self._pending_typing.pop(room_id, None)
+
+    async def _execute(self, room_id: str, job: _Job) -> None:
+        response = None
+        try:
+            for _ in range(self.max_retries + 1):
+                await self.bucket.acquire(0 if job.is_typing else 1)
+                response = await job.send()
+                retry_after = _retry_after(response)
+                if retry_after is None:
+                    break
+                metrics.counter(
+                    "matrix_send_rate_limited_total", "M_LIMIT_EXCEEDED answers of the homeserver"
+                ).inc()
+                logger.warning(
+                    "Rate limited by the homeserver", room_id=room_id, retry_after=retry_after
+                )
+                self.bucket.pause(retry_after)
+        except Exception as send_exception:
+            if job.future and not job.future.done():
+                job.future.set_exception(send_exception)
+            elif not job.future:
+                logger.warning(
+                    "Failed to send typing notification", room_id=room_id, error=str(send_exception)
+                )
+            return
+
+        if not job.is_typing:
+            latency = time.perf_counter() - job.submitted_at
+            metrics.histogram(
+                "matrix_send_latency_seconds", "Time from the submission to the sending of events"
+            ).observe(latency)
+        if job.future and not job.future.done():
+            job.future.set_result(response)
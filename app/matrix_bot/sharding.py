@@ -0,0 +1,253 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Sharded deployment: the main process owns the Matrix sync and the E2E crypto, and
+dispatches the decrypted events to worker processes by hash of the room id.
+The workers run the callbacks with a RemoteMatrixClient, whose requests (sending
+messages, fetching history...) are executed by the main process.
+
+Messages are pickled before being queued, so that a non picklable payload fails
+in the caller instead of in the multiprocessing feeder thread.
+"""
+
+import asyncio
+import importlib
+import itertools
+import multiprocessing
+import pickle
+import zlib
+from queue import Empty
+from typing import Callable
+
+from nio import MatrixRoom, Response
+
+from .callbacks import Callbacks
+from .client import MatrixClient, render_markdown
+from .config import bot_lib_config, logger
+from .executor import run_cpu
+from .metrics import log_metrics, metrics
+from .tracing import span
+
+
+# The MatrixClient methods the handlers may call in a worker, run by the main process
+REMOTE_METHODS = frozenset(
+    {
+        "room_typing",
+        "send_text_message",
+        "send_html_message",
+        "send_reaction",
+        "send_image_message",
+        "send_video_message",
+        "send_file_message",
+        "get_display_name",
+        "room_messages",
+        "room_get_event",
+        "download",
+        "join",
+    }
+)
+SUPERVISE_INTERVAL = 5  # seconds between two checks of the worker processes
+
+
+def shard_for(room_id: str, n_shards: int) -> int:
+    """Stable across processes and restarts, unlike hash()"""
+    return zlib.crc32(room_id.encode()) % n_shards
+
+
+async def _receive(queue) -> tuple:
+    """Wait for a message without blocking the loop (the timeout lets the loop shut down)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            return pickle.loads(await loop.run_in_executor(None, queue.get, True, 1))
+        except Empty:
+            continue
+
+
+def _import_setup(setup: str) -> Callable[[Callbacks], None]:
+    module_name, _, func_name = setup.partition(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+class RemoteMatrixClient:
+    """
+    Stand-in of the MatrixClient in a worker process.
+    The methods of REMOTE_METHODS can be called on it: the call is run by the main process.
+    The other attributes of the client (rooms, olm...) only exist in the main process.
+    """
+
+    def __init__(self, shard: int, outbound: multiprocessing.Queue):
+        self.shard = shard
+        self.outbound = outbound
+        self.user_id: str | None = None
+        self.next_batch: str | None = None
+        self._calls: dict[int, asyncio.Future] = {}
+        self._call_ids = itertools.count()
+
+    def __getattr__(self, method: str):
+        if method not in REMOTE_METHODS:
+            raise AttributeError(f"{method} is not available in the shard workers")
+
+        async def remote_call(*args, **kwargs):
+            call_id = next(self._call_ids)
+            future = asyncio.get_running_loop().create_future()
+            self._calls[call_id] = future
+            self.outbound.put(pickle.dumps(("call", self.shard, call_id, method, args, kwargs)))
+            return await future
+
+        return remote_call
+
+    async def send_markdown_message(self, room_id: str, message: str, **kwargs):
+        # Render in the worker: it is the CPU-heavy part of sending an answer.
+        with span("render_markdown"):
+            message = await run_cpu(render_markdown, message)
+        return await self.send_html_message(room_id, message, **kwargs)
+
+    def resolve(self, call_id: int, ok: bool, value) -> None:
+        future = self._calls.pop(call_id, None)
+        if future is None or future.done():  # The caller was cancelled
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+
+async def _dispatch(callbacks: Callbacks, lock: asyncio.Lock, room: MatrixRoom, event) -> None:
+    async with lock:  # keep the order of the events of a room
+        for func, on_event in callbacks.client_callback:
+            if isinstance(event, on_event):
+                await func(room, event)
+
+
+async def _worker_loop(shard: int, inbound, outbound, setup: Callable[[Callbacks], None]):
+    matrix_client = RemoteMatrixClient(shard, outbound)
+    callbacks = Callbacks(matrix_client)
+    setup(callbacks)
+    room_locks: dict[str, asyncio.Lock] = {}
+    tasks: set[asyncio.Task] = set()
+    logger.info("Shard worker started", shard=shard)
+    if bot_lib_config.metrics_log_interval:
+        # The /metrics endpoint only sees the main process: the workers log their own metrics.
+        interval = bot_lib_config.metrics_log_interval
+        tasks.add(asyncio.create_task(log_metrics(interval, shard=shard)))
+
+    while True:
+        kind, *payload = await _receive(inbound)
+        if kind == "stop":
+            break
+        elif kind == "result":
+            matrix_client.resolve(*payload)
+        elif kind == "event":
+            room, event, state = payload
+            matrix_client.user_id = state["user_id"]
+            matrix_client.next_batch = state["next_batch"]
+            lock = room_locks.setdefault(room.room_id, asyncio.Lock())
+            task = asyncio.create_task(_dispatch(callbacks, lock, room, event))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+
+def worker_main(shard: int, inbound, outbound, setup: str) -> None:
+    """Entry point of a worker process"""
+    # Imported before starting the loop: the app modules may run their own loop at import time.
+    setup_func = _import_setup(setup)
+    asyncio.run(_worker_loop(shard, inbound, outbound, setup_func))
+
+
+class ShardedDispatcher:
+    """Main process side: start the workers, forward them the events and serve their requests"""
+
+    def __init__(self, matrix_client: MatrixClient, n_workers: int, setup: str):
+        self.matrix_client = matrix_client
+        self.n_workers = n_workers
+        self.setup = setup
+        self.processes: list = []
+        self.inbounds: list = []
+        self.outbound = None
+        self._context = multiprocessing.get_context("spawn")
+        self._tasks: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        self.outbound = self._context.Queue()
+        for shard in range(self.n_workers):
+            self.inbounds.append(self._context.Queue())
+            self.processes.append(self._start_worker(shard))
+        self._spawn(self._serve_calls())
+        self._spawn(self._supervise())
+
+    def _start_worker(self, shard: int):
+        process = self._context.Process(
+            target=worker_main,
+            args=(shard, self.inbounds[shard], self.outbound, self.setup),
+            name=f"matrix-bot-shard-{shard}",
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    async def _supervise(self) -> None:
+        """Start again the workers that died, their rooms would not be handled anymore"""
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for shard, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                logger.error(
+                    "Shard worker died, restarting it", shard=shard, exitcode=process.exitcode
+                )
+                metrics.counter(
+                    "shard_restarts_total", "Shard workers restarted", shard=shard
+                ).inc()
+                # A new queue: the events left in the old one may be the cause of the crash
+                self.inbounds[shard] = self._context.Queue()
+                self.processes[shard] = self._start_worker(shard)
+
+    def stop(self) -> None:
+        for inbound in self.inbounds:
+            inbound.put(pickle.dumps(("stop",)))
+        for process in self.processes:
+            process.join(timeout=10)
+        self.processes.clear()
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def forward(self, room: MatrixRoom, event) -> None:
+        """nio event callback: send the event to the worker of its room"""
+        shard = shard_for(room.room_id, self.n_workers)
+        state = {"user_id": self.matrix_client.user_id, "next_batch": self.matrix_client.next_batch}
+        try:
+            message = pickle.dumps(("event", room, event, state))
+        except Exception as pickle_error:
+            logger.error(
+                "Could not forward event", event_id=event.event_id, error=str(pickle_error)
+            )
+            return
+        self.inbounds[shard].put(message)
+        metrics.counter("shard_events_total", "Events forwarded to the workers", shard=shard).inc()
+
+    async def _serve_calls(self) -> None:
+        while True:
+            _, shard, call_id, method, args, kwargs = await _receive(self.outbound)
+            self._spawn(self._call(shard, call_id, method, args, kwargs))
+
+    async def _call(self, shard: int, call_id: int, method: str, args, kwargs) -> None:
+        try:
+            if method not in REMOTE_METHODS:
+                raise AttributeError(method)
+            value, ok = await getattr(self.matrix_client, method)(*args, **kwargs), True
+        except Exception as call_exception:
+            logger.exception("Remote call failed", shard=shard, method=method)
+            value, ok = call_exception, False
+        if isinstance(value, Response):
+            value.transport_response = None  # the aiohttp response can't be pickled
+        try:
+            message = pickle.dumps(("result", call_id, ok, value))
+        except Exception as pickle_error:
+            message = pickle.dumps(("result", call_id, False, RuntimeError(str(pickle_error))))
+        self.inbounds[shard].put(message)
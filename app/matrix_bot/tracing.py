@@ -0,0 +1,202 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Request tracing: each handled event opens a trace, and the steps it goes through (IAM,
+history, search, generation, rendering, sending) are recorded as child spans.
+
+The current span is kept in a context variable, so it follows the awaits of the handler
+without being passed around. Finished traces are appended to `bot_lib_config.trace_file`
+in the zipkin v2 JSON format (one array of spans per line), and the last trace of each
+room is kept in memory for `!debug`.
+
+The tasks started by a handler copy its context, but may outlive its trace: they record
+their spans in a detached trace of their own (see start_detached_trace), and a span whose
+parent is already finished is not recorded.
+"""
+
+import contextvars
+import functools
+import hashlib
+import inspect
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from .config import bot_lib_config, logger
+
+SERVICE_NAME = "albert-tchap"
+MAX_ROOMS_KEPT = 1000
+
+
+@dataclass
+class Span:
+    trace_id: str
+    name: str
+    parent: "Span | None" = field(default=None, repr=False)
+    span_id: str = field(default_factory=lambda: os.urandom(8).hex())
+    tags: dict = field(default_factory=dict)
+    start: float = field(default_factory=time.time)
+    duration: float | None = None
+    children: list["Span"] = field(default_factory=list)
+    discarded: bool = False
+
+    def to_zipkin(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "id": self.span_id,
+            "name": self.name,
+            "timestamp": int(self.start * 1_000_000),
+            "duration": int((self.duration or 0) * 1_000_000),
+            "localEndpoint": {"serviceName": SERVICE_NAME},
+            "tags": {k: str(v) for k, v in self.tags.items()},
+        }
+        if self.parent:
+            span["parentId"] = self.parent.span_id
+        return span
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+_last_traces: OrderedDict[str, Span] = OrderedDict()
+
+
+def trace_id_for(event_id: str) -> str:
+    """All the handlers of an event share the same trace id"""
+    return hashlib.sha256(event_id.encode()).hexdigest()[:32]
+
+
+@contextmanager
+def start_trace(name: str, event_id: str, room_id: str, **tags):
+    """Open the root span of a handler, the trace is recorded when the block ends"""
+    tags = {"room_id": room_id, "event_id": event_id, **tags}
+    root = Span(trace_id_for(event_id), name, tags=tags)
+    with _record_trace(root, keep_last=True):
+        yield root
+
+
+@contextmanager
+def start_detached_trace(name: str, **tags):
+    """
+    Open the root span of a task that may outlive the handler starting it. The trace is
+    recorded on its own, as a follow-up of the current span if any, and is not kept for
+    `!debug` (which shows the last handled event of the room).
+    """
+    parent = _current_span.get()
+    trace_id = parent.trace_id if parent else os.urandom(16).hex()
+    # Not added to the children of the parent, which may be exported before the task ends
+    root = Span(trace_id, name, parent=parent, tags=tags)
+    with _record_trace(root, keep_last=False):
+        yield root
+
+
+@contextmanager
+def _record_trace(root: Span, keep_last: bool):
+    token = _current_span.set(root)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as error:
+        root.tags["error"] = type(error).__name__
+        raise
+    finally:
+        root.duration = time.perf_counter() - start
+        _current_span.reset(token)
+        if not root.discarded:
+            _finish_trace(root, keep_last)
+
+
+def discard_trace(span: Span) -> None:
+    """Do not record this trace (e.g. the event did not concern the handler)"""
+    span.discarded = True
+
+
+@contextmanager
+def span(name: str, **tags):
+    """Record a child span of the current span. No-op outside of a trace, or of a finished one."""
+    parent = _current_span.get()
+    if parent is None or parent.duration is not None:
+        yield None
+        return
+    child = Span(parent.trace_id, name, parent=parent, tags=tags)
+    parent.children.append(child)
+    token = _current_span.set(child)
+    start = time.perf_counter()
+    try:
+        yield child
+    except Exception as error:
+        child.tags["error"] = type(error).__name__
+        raise
+    finally:
+        child.duration = time.perf_counter() - start
+        _current_span.reset(token)
+
+
+def traced(name: str | None = None):
+    """Decorator recording a span for each call of a function or coroutine function"""
+
+    def decorator(func):
+        span_name = name or func.__name__
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _finish_trace(root: Span, keep_last: bool) -> None:
+    if keep_last:
+        room_id = root.tags["room_id"]
+        _last_traces[room_id] = root
+        _last_traces.move_to_end(room_id)
+        while len(_last_traces) > MAX_ROOMS_KEPT:
+            _last_traces.popitem(last=False)
+
+    if bot_lib_config.trace_file:
+        try:
+            with open(bot_lib_config.trace_file, "a") as trace_file:
+                trace_file.write(json.dumps([s.to_zipkin() for s in root.walk()]) + "\n")
+        except OSError as write_error:
+            logger.warning("Could not export trace", error=str(write_error))
+
+
+def last_trace_summary(room_id: str) -> str | None:
+    """Indented list of the spans of the last finished trace of a room, with their durations"""
+    root = _last_traces.get(room_id)
+    if root is None:
+        return None
+
+    lines = []
+
+    def add(span: Span, depth: int):
+        if span.duration is None:  # Of a task still running
+            lines.append(f"{'  ' * depth}- {span.name}: en cours")
+        else:
+            lines.append(f"{'  ' * depth}- {span.name}: {span.duration * 1000:.0f} ms")
+        for child in span.children:
+            add(child, depth + 1)
+
+    add(root, 0)
+    return "\n".join(lines)
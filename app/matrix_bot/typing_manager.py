@@ -0,0 +1,61 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+from typing import Callable
+
+from .metrics import metrics
+
+
+class TypingManager:
+    """
+    Track the typing state of the bot in each room and only emit the transitions.
+
+    While the bot is typing, the notification is re-emitted before the homeserver timeout
+    expires, so that long generations keep showing the typing indicator. The refresh stops
+    after `max_duration` seconds in case a handler never clears the state.
+    """
+
+    def __init__(
+        self,
+        emit: Callable[[str, bool, int], None],
+        timeout: int = 30_000,
+        max_duration: float = 600,
+    ):
+        self.emit = emit
+        self.timeout = timeout
+        self.max_duration = max_duration
+        self._refresh_tasks: dict[str, asyncio.Task] = {}
+
+    def is_typing(self, room_id: str) -> bool:
+        return room_id in self._refresh_tasks
+
+    def set_typing(self, room_id: str, typing_state: bool) -> None:
+        if typing_state == self.is_typing(room_id):
+            metrics.counter("matrix_typing_dropped_total", "Redundant typing notifications").inc()
+            return
+
+        if typing_state:
+            self._refresh_tasks[room_id] = asyncio.create_task(self._refresh(room_id))
+        else:
+            self._refresh_tasks.pop(room_id).cancel()
+        self._emit(room_id, typing_state)
+
+    def _emit(self, room_id: str, typing_state: bool) -> None:
+        metrics.counter(
+            "matrix_typing_emitted_total", "Typing notifications sent", state=str(typing_state)
+        ).inc()
+        self.emit(room_id, typing_state, self.timeout)
+
+    async def _refresh(self, room_id: str) -> None:
+        period = 0.8 * self.timeout / 1000
+        elapsed = 0.0
+        try:
+            while elapsed + period < self.max_duration:
+                await asyncio.sleep(period)
+                elapsed += period
+                self._emit(room_id, True)
+        finally:
+            if self._refresh_tasks.get(room_id) is asyncio.current_task():
+                del self._refresh_tasks[room_id]
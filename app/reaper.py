@@ -0,0 +1,125 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Deletion of the private collections of the rooms that are not used anymore.
+
+The private collection of a room is named after the room id (see albert_document). It is
+only flushed when the user comes back after a pause, so the collections of the abandoned
+rooms would stay forever.
+
+The reaper deletes documents sent by the users, so it is disabled by default: set
+ALBERT_REAPER_INTERVAL (e.g. 3600) and ALBERT_REAPER_MAX_IDLE (7 days by default) to enable it.
+It runs in the process that syncs: with shard workers, the rooms handled by the workers are
+not in `last_activity`, and their last event is fetched from the homeserver instead.
+"""
+
+import asyncio
+import os
+import time
+
+from matrix_bot.client import MatrixClient
+from matrix_bot.config import logger
+from matrix_bot.metrics import metrics
+from nio import MessageDirection
+
+import background
+import collection_index
+from config import env_config
+from core_llm import API_PREFIX_V1, AlbertApiClient
+from tchap_utils import matrix_request
+
+# Last activity of the rooms handled by this process, to spare a request for the active ones
+last_activity: dict[str, float] = {}
+
+
+def touch(room_id: str) -> None:
+    last_activity[room_id] = time.time()
+
+
+def is_room_collection(collection: dict) -> bool:
+    name = collection["name"]
+    return collection.get("type") == "private" and name.startswith("!") and ":" in name
+
+
+async def get_last_activity(matrix_client: MatrixClient, room_id: str) -> float:
+    """Timestamp of the last activity in the room, 0 if the bot is not in the room anymore"""
+    recent = last_activity.get(room_id, 0.0)
+    if time.time() - recent < env_config.albert_reaper_max_idle:
+        return recent
+    if room_id not in matrix_client.rooms:
+        return 0.0
+    # The shard workers or a previous run of the bot may have seen newer messages
+    response = await matrix_request(
+        matrix_client.room_messages,
+        room_id,
+        matrix_client.next_batch,
+        limit=1,
+        direction=MessageDirection.back,
+    )
+    if response.chunk:
+        recent = max(recent, response.chunk[0].server_timestamp / 1000)
+    return recent
+
+
+async def reap_collection(aclient: AlbertApiClient, collection: dict) -> None:
+    documents = await asyncio.to_thread(aclient.fetch_documents, collection["id"])
+    await asyncio.to_thread(aclient.delete_collection, collection["id"])
+    last_activity.pop(collection["name"], None)
+    await collection_index.forget(collection["name"])
+    metrics.counter("albert_reaped_collections_total", "Stale private collections deleted").inc()
+    metrics.counter(
+        "albert_reaped_documents_total", "Documents of the stale private collections"
+    ).inc(len(documents))
+
+
+async def reap_stale_collections(matrix_client: MatrixClient) -> None:
+    """Delete the private collections of the rooms idle for more than albert_reaper_max_idle"""
+    config = env_config
+    url = os.path.join(config.albert_api_url, API_PREFIX_V1)
+    aclient = AlbertApiClient(base_url=url, api_key=config.albert_api_token)
+    collections = await asyncio.to_thread(aclient.fetch_collections)
+
+    now = time.time()
+    stale = []
+    skipped = 0
+    for collection in filter(is_room_collection, collections.values()):
+        room_id = collection["name"]
+        if background.is_pending(room_id):  # Being flushed
+            continue
+        try:
+            last_active = await get_last_activity(matrix_client, room_id)
+        except Exception as activity_error:
+            # Left for the next run, not to stop the reaping of the other rooms
+            skipped += 1
+            metrics.counter(
+                "albert_reaper_skipped_rooms_total", "Rooms whose last activity is unknown"
+            ).inc()
+            logger.warning(
+                "Could not get the room activity", room_id=room_id, error=str(activity_error)
+            )
+            continue
+        if now - last_active > config.albert_reaper_max_idle:
+            stale.append(collection)
+
+    errors = 0
+    batch_size = config.albert_reaper_batch_size
+    for i in range(0, len(stale), batch_size):
+        batch = stale[i : i + batch_size]
+        results = await asyncio.gather(
+            *(reap_collection(aclient, collection) for collection in batch),
+            return_exceptions=True,
+        )
+        for collection, result in zip(batch, results):
+            if isinstance(result, Exception):
+                errors += 1
+                logger.warning(
+                    "Could not reap collection", collection_id=collection["id"], error=str(result)
+                )
+    logger.info(
+        "Stale private collections reaped",
+        reaped=len(stale) - errors,
+        errors=errors,
+        skipped=skipped,
+    )
@@ -0,0 +1,94 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Local re-ranking of the chunks returned by the /search endpoint of the Albert API.
+
+A larger set of candidates is requested, then:
+- near-duplicate chunks (same document sent twice, overlapping chunks...) are removed,
+  by the Jaccard similarity of their word shingles,
+- the candidates are ranked by their similarity score and by a BM25 score on the query,
+  and both rankings are fused with the Reciprocal Rank Fusion,
+so that the k chunks put in the prompt are the most relevant and the least redundant.
+"""
+
+import math
+import re
+import zlib
+from collections import Counter
+
+SHINGLE_SIZE = 5
+DUPLICATE_THRESHOLD = 0.8
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+
+_word_re = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    return [word for word in _word_re.findall(text.lower()) if len(word) > 1]
+
+
+def shingles(words: list[str], size: int = SHINGLE_SIZE) -> set[int]:
+    if len(words) <= size:
+        return {zlib.crc32(" ".join(words).encode())}
+    return {
+        zlib.crc32(" ".join(words[i : i + size]).encode()) for i in range(len(words) - size + 1)
+    }
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def deduplicate(chunks: list[dict], threshold: float = DUPLICATE_THRESHOLD) -> list[dict]:
+    """Keep the first of the chunks with similar contents (the chunks come by decreasing score)"""
+    kept: list[tuple[dict, set[int]]] = []
+    for chunk in chunks:
+        chunk_shingles = shingles(tokenize(chunk["content"]))
+        if all(jaccard(chunk_shingles, other) < threshold for _, other in kept):
+            kept.append((chunk, chunk_shingles))
+    return [chunk for chunk, _ in kept]
+
+
+def bm25_scores(query: str, chunks: list[dict]) -> list[float]:
+    """BM25 score of each chunk for the query, the statistics being those of the candidates"""
+    documents = [Counter(tokenize(chunk["content"])) for chunk in chunks]
+    if not documents:
+        return []
+    average_length = sum(sum(d.values()) for d in documents) / len(documents) or 1
+    terms = set(tokenize(query))
+    document_frequency = {term: sum(term in d for d in documents) for term in terms}
+    scores = []
+    for document in documents:
+        length = sum(document.values())
+        score = 0.0
+        for term in terms:
+            frequency = document[term]
+            if not frequency:
+                continue
+            n = document_frequency[term]
+            idf = math.log(1 + (len(documents) - n + 0.5) / (n + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+            score += idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        scores.append(score)
+    return scores
+
+
+def rerank(query: str, chunks: list[dict], k: int) -> list[dict]:
+    """The k best chunks, by the fusion of their similarity and BM25 ranks"""
+    chunks = deduplicate(sorted(chunks, key=lambda chunk: -chunk.get("score", 0)))
+    bm25 = bm25_scores(query, chunks)
+    bm25_rank = {
+        index: rank for rank, index in enumerate(sorted(range(len(chunks)), key=lambda i: -bm25[i]))
+    }
+    fused = [
+        1 / (RRF_K + similarity_rank + 1) + 1 / (RRF_K + bm25_rank[similarity_rank] + 1)
+        for similarity_rank in range(len(chunks))
+    ]
+    best = sorted(range(len(chunks)), key=lambda i: -fused[i])[:k]
+    return [chunks[i] for i in best]
@@ -0,0 +1,117 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Sources of the answers: the chunks used to generate each answer, by event id of the answer,
+so that `!sources` can explain any of them (in reply to it, or by reacting to it).
+
+Only the ids and metadata of the chunks are stored, in a sqlite database keeping the
+`max_answers` last answers. Their contents are kept in memory for the recent answers only,
+and fetched from the Albert API for the others.
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from config import Config, env_config
+from core_llm import fetch_chunks
+from utils import TTLCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    event_id TEXT PRIMARY KEY,
+    room_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    chunks TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sources_by_room ON sources (room_id, created_at);
+"""
+
+
+def chunk_ref(chunk: dict) -> dict:
+    """What is stored of a chunk"""
+    metadata = chunk.get("metadata") or {}
+    return {
+        "id": chunk["id"],
+        "collection_id": metadata.get("collection_id") or metadata.get("collection"),
+        "document_name": metadata.get("document_name"),
+        "score": chunk.get("score"),
+    }
+
+
+class SourcesStore:
+    def __init__(self, path: Path, max_answers: int, contents_cache_size: int = 2000):
+        self.path = path
+        self.max_answers = max_answers
+        self.contents = TTLCache(contents_cache_size, ttl=24 * 3600)  # chunk id -> content
+        self._db: sqlite3.Connection | None = None
+        # The queries run in the threads of asyncio.to_thread, not to block the event loop
+        self._lock = threading.Lock()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            # The shard workers share the database: WAL lets them write concurrently.
+            self._db = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None, check_same_thread=False
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    async def save(self, event_id: str, room_id: str, chunks: list[dict]) -> None:
+        for chunk in chunks:
+            self.contents.set(chunk["id"], chunk["content"])
+        refs = json.dumps([chunk_ref(chunk) for chunk in chunks])
+        await asyncio.to_thread(self._save, event_id, room_id, refs)
+
+    def _save(self, event_id: str, room_id: str, refs: str) -> None:
+        with self._lock:
+            cursor = self.db.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                (event_id, room_id, time.time(), refs),
+            )
+            # The rowids grow with the insertions: the oldest answers are pruned by rowid,
+            # with a range delete on the table b-tree rather than a sort of the table.
+            self.db.execute(
+                "DELETE FROM sources WHERE rowid <= ?", (cursor.lastrowid - self.max_answers,)
+            )
+
+    async def get(self, event_id: str) -> list[dict] | None:
+        """Chunk references of an answer, None if the event is not a known answer"""
+        return await asyncio.to_thread(
+            self._fetch_refs, "SELECT chunks FROM sources WHERE event_id = ?", event_id
+        )
+
+    async def last(self, room_id: str) -> list[dict] | None:
+        """Chunk references of the last answer in the room"""
+        return await asyncio.to_thread(
+            self._fetch_refs,
+            "SELECT chunks FROM sources WHERE room_id = ? ORDER BY created_at DESC LIMIT 1",
+            room_id,
+        )
+
+    def _fetch_refs(self, query: str, key: str) -> list[dict] | None:
+        with self._lock:
+            row = self.db.execute(query, (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def load_contents(self, config: Config, refs: list[dict]) -> list[dict]:
+        """The chunks with their content (None if it can't be found)"""
+        missing = [
+            ref for ref in refs if ref["collection_id"] and self.contents.get(ref["id"]) is None
+        ]
+        if missing:
+            for chunk_id, content in (await fetch_chunks(config, missing)).items():
+                self.contents.set(chunk_id, content)
+        return [{**ref, "content": self.contents.get(ref["id"])} for ref in refs]
+
+
+sources_store = SourcesStore(env_config.sources_path, env_config.sources_max_answers)
@@ -7,11 +7,14 @@ from typing import Optional
 from io import BytesIO
 
 from matrix_bot.eventparser import EventParser
-from nio import Event, MatrixRoom, MessageDirection
+from matrix_bot.executor import run_cpu
+from matrix_bot.tracing import traced
+from nio import ErrorResponse, Event, MatrixRoom, MessageDirection
 from nio.crypto.attachments import decrypt_attachment
 
 from bot_msg import AlbertMsg
 from config import Config
+from utils import MatrixResponseError, retry
 
 
 def has_keys_along(nested_dict: dict, keys: list[str]) -> bool:
@@ -33,6 +36,16 @@ def isa_reply_to(event) -> bool:
 #
 
 
+@retry()
+async def matrix_request(method, *args, **kwargs):
+    """Call a nio client method, raising (and retrying) its error responses"""
+    response = await method(*args, **kwargs)
+    if isinstance(response, ErrorResponse):
+        raise MatrixResponseError(response)
+    return response
+
+
+@traced()
 async def get_thread_messages(
     config: Config, ep: EventParser, max_rewind: int = 100
 ) -> list[Event]:
@@ -45,7 +58,9 @@ async def get_thread_messages(
     while isa_reply_to(event) and i < max_rewind:
         messages.insert(0, event)
         previous_event_id = event.source["content"]["m.relates_to"]["m.in_reply_to"]["event_id"]
-        previous = await matrix_client.room_get_event(ep.room.room_id, previous_event_id)
+        previous = await matrix_request(
+            matrix_client.room_get_event, ep.room.room_id, previous_event_id
+        )
         event = previous.event
         i += 1
 
@@ -56,13 +71,15 @@ async def get_thread_messages(
     return messages
 
 
+@traced()
 async def get_previous_messages(
     config: Config, ep: EventParser, history_lookup: int = 10, max_rewind: int = 100
 ) -> list[Event]:
     matrix_client = ep.matrix_client
     # Build the conversation history
     starttoken = matrix_client.next_batch
-    roommessages = await matrix_client.room_messages(
+    roommessages = await matrix_request(
+        matrix_client.room_messages,
         ep.room.room_id,
         starttoken,
         limit=min(config.albert_history_lookup, config.albert_max_rewind),
@@ -106,12 +123,13 @@ def get_cleanup_body(event: Event) -> str:
 
 
 async def get_decrypted_file(ep: EventParser) -> BytesIO:
-    response = await ep.matrix_client.download(ep.event.url)
-    content = decrypt_attachment(
-        response.body, 
-        ep.event.key.get('k'), 
-        ep.event.hashes['sha256'], 
-        ep.event.iv
+    response = await matrix_request(ep.matrix_client.download, ep.event.url)
+    content = await run_cpu(
+        decrypt_attachment,
+        response.body,
+        ep.event.key.get('k'),
+        ep.event.hashes['sha256'],
+        ep.event.iv,
     )
     file = BytesIO(content)
     file.name = ep.event.source['content']['body']
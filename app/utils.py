@@ -1,38 +1,182 @@
 """Copy from pyalbert !"""
 
+import asyncio
 import functools
+import inspect
+import itertools
 import json
+import random
 import time
+from collections import OrderedDict
 from typing import Generator
 
+import aiohttp
+import httpx
+import openai
+import requests
+from matrix_bot.config import logger
+from matrix_bot.metrics import metrics
 from requests import Response
 
-
-def retry(tries: int = 3, delay: int = 2):
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+
+
+class TTLCache:
+    """LRU cache whose entries also expire `ttl` seconds after being set"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if time.monotonic() > expires_at:
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class MatrixResponseError(Exception):
+    """An error response returned by nio (which returns errors instead of raising them)"""
+
+    def __init__(self, response):
+        super().__init__(str(response))
+        self.response = response
+        transport_response = getattr(response, "transport_response", None)
+        self.status = transport_response.status if transport_response is not None else None
+        if getattr(response, "status_code", None) == "M_LIMIT_EXCEEDED":
+            self.status = 429
+        retry_after_ms = getattr(response, "retry_after_ms", None)
+        self.retry_after = retry_after_ms / 1000 if retry_after_ms else None
+
+
+def _status_of(error: Exception) -> int | None:
+    """HTTP status of the error raised by requests, aiohttp, openai or nio"""
+    response = getattr(error, "response", None)
+    for status in (
+        getattr(error, "status", None),  # aiohttp, MatrixResponseError
+        getattr(error, "status_code", None),  # openai
+        getattr(response, "status_code", None),  # requests
+    ):
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def _retry_after(error: Exception) -> float | None:
+    """Delay asked by the server, in seconds (only the delay-seconds form of Retry-After)"""
+    if getattr(error, "retry_after", None):
+        return error.retry_after
+    headers = getattr(error, "headers", None) or getattr(
+        getattr(error, "response", None), "headers", None
+    )
+    try:
+        return float(headers["Retry-After"]) if headers and "Retry-After" in headers else None
+    except ValueError:
+        return None
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Timeouts, connection errors and the HTTP statuses telling to come back later"""
+    if isinstance(
+        error,
+        (
+            TimeoutError,  # also asyncio.TimeoutError
+            ConnectionError,  # connection reset, refused...
+            requests.Timeout,
+            requests.ConnectionError,
+            aiohttp.ClientConnectionError,  # also aiohttp timeouts
+            httpx.TransportError,
+            openai.APITimeoutError,
+            openai.APIConnectionError,
+        ),
+    ):
+        return True
+    return _status_of(error) in RETRYABLE_STATUSES
+
+
+def retry(
+    tries: int = 3,
+    base_delay: float = 0.5,
+    max_delay: float = 10,
+    deadline: float = 30,
+    is_retryable=is_retryable_error,
+):
     """
-    A simple retry decorator that catch exception to retry multiple times
-    @TODO: only catch only network error/timeout error.
-
-    Parameters:
-    - tries: Number of total attempts.
-    - delay: Delay between retries in seconds.
+    Retry decorator for functions and coroutine functions.
+
+    Only the errors accepted by `is_retryable` are retried (other errors are raised right
+    away), with a full jitter exponential backoff: a random delay between 0 and
+    `base_delay * 2**attempt` (at most `max_delay`), or the Retry-After of the server.
+    The last error is raised once `tries` attempts are made, or if the next attempt would
+    start after `deadline` seconds from the first one.
+    Sync functions sleep with time.sleep: from a coroutine, call them with asyncio.to_thread.
     """
 
+    def next_delay(func, attempt: int, start: float, error: Exception) -> float | None:
+        if attempt + 1 >= tries or not is_retryable(error):
+            return None
+        delay = _retry_after(error) or random.uniform(0, min(max_delay, base_delay * 2**attempt))
+        if time.monotonic() - start + delay > deadline:
+            return None
+        metrics.counter(
+            "retry_total", "Retried calls", func=func.__qualname__, error=type(error).__name__
+        ).inc()
+        logger.warning(
+            "Retrying",
+            func=func.__qualname__,
+            error=str(error) or type(error).__name__,
+            attempt=attempt + 1,
+            delay=round(delay, 2),
+        )
+        return delay
+
     def decorator_retry(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.monotonic()
+                for attempt in itertools.count():
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception as error:
+                        delay = next_delay(func, attempt, start, error)
+                        if delay is None:
+                            raise
+                    await asyncio.sleep(delay)
+
+            return async_wrapper
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            attempts = tries
-            while attempts > 1:
+            start = time.monotonic()
+            for attempt in itertools.count():
                 try:
                     return func(*args, **kwargs)
-                # @TODO: Catch network error.
-                #except (requests.exceptions.RequestException, httpx.RequestError) as e:
-                except Exception as e:
-                    print(f"Error: {e}, retrying in {delay} seconds...")
-                    time.sleep(delay)
-                    attempts -= 1
-            # Final attempt without catching exceptions
-            return func(*args, **kwargs)
+                except Exception as error:
+                    delay = next_delay(func, attempt, start, error)
+                    if delay is None:
+                        raise
+                time.sleep(delay)
 
         return wrapper
 
@@ -50,6 +194,19 @@ def log_and_raise_for_status(response: Response, msg_on_error: str = "API Error
         response.raise_for_status()
 
 
+async def alog_and_raise_for_status(
+    response: aiohttp.ClientResponse, msg_on_error: str = "API Error detail"
+):
+    # response from aiohttp
+    if not response.ok:
+        try:
+            error_detail = (await response.json()).get("detail")
+        except Exception:
+            error_detail = await response.text()
+        print(f"{msg_on_error}: {error_detail}\n")
+        response.raise_for_status()
+
+
 #
 # Openai stream SSE decoder
 #
@@ -0,0 +1,361 @@
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Stand-ins for the services the bot talks to, for the load test:
+- a Matrix homeserver with one direct room per simulated user (no encryption),
+- an OpenAI compatible Albert API (models, search, collections, chat completions),
+- a Grist users table in which every simulated user is allowed.
+
+They run in their own process (see `run_fake_servers`), so that their CPU time is not
+accounted to the bot. The load driver posts the user messages on `/_bench/message`, which
+answers once the bot has replied in the room, with the reply latency measured here.
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+BOT_USER = "@albert:bench.localhost"
+SERVER_NAME = "bench.localhost"
+
+
+def user_id(i: int) -> str:
+    # The domain is read by TchapIam.domain_from_sender, between the last "-" and ":"
+    return f"@user{i}-bench.gouv.fr:{SERVER_NAME}"
+
+
+def room_id(i: int) -> str:
+    return f"!room{i}:{SERVER_NAME}"
+
+
+@dataclass
+class FakeSettings:
+    n_users: int = 1000
+    albert_latency: float = 0.5
+    albert_jitter: float = 0.2
+    albert_error_rate: float = 0.0
+    search_latency: float = 0.05
+    grist_latency: float = 0.02
+    answer_words: int = 150
+    stream_chunk_delay: float = 0.01
+
+
+@dataclass
+class Room:
+    room_id: str
+    user: str
+    state: list[dict]
+    timeline: list[tuple[int, dict]] = field(default_factory=list)
+    pending: deque = field(default_factory=deque)  # (sent_at, future) of the user messages
+
+
+class FakeHomeserver:
+    def __init__(self, settings: FakeSettings):
+        self.settings = settings
+        self.stream = itertools.count(1)
+        self.position = 0
+        self.new_events = asyncio.Condition()
+        self.rooms = {room_id(i): self._new_room(i) for i in range(settings.n_users)}
+        self.unexpected: dict[str, int] = {}
+
+    def _new_room(self, i: int) -> Room:
+        rid, user = room_id(i), user_id(i)
+        ts = int(time.time() * 1000)
+
+        def state_event(event_type: str, content: dict, state_key: str = "", sender=BOT_USER):
+            return {
+                "type": event_type,
+                "state_key": state_key,
+                "content": content,
+                "sender": sender,
+                "event_id": f"$state-{rid}-{event_type}-{state_key}",
+                "origin_server_ts": ts,
+                "unsigned": {},
+            }
+
+        state = [
+            state_event("m.room.create", {"creator": BOT_USER, "room_version": "10"}),
+            state_event("m.room.member", {"membership": "join"}, BOT_USER),
+            state_event("m.room.member", {"membership": "join"}, user, sender=user),
+            state_event("m.room.power_levels", {"users": {BOT_USER: 100, user: 100}}),
+        ]
+        return Room(rid, user, state)
+
+    def _event(self, sender: str, content: dict) -> dict:
+        return {
+            "type": "m.room.message",
+            "event_id": f"${next(self.stream)}-{random.getrandbits(32):x}",
+            "sender": sender,
+            "origin_server_ts": int(time.time() * 1000),
+            "content": content,
+            "unsigned": {},
+        }
+
+    async def _append(self, room: Room, event: dict) -> None:
+        async with self.new_events:
+            self.position += 1
+            room.timeline.append((self.position, event))
+            self.new_events.notify_all()
+
+    # Matrix client-server API
+
+    async def versions(self, request):
+        return web.json_response({"versions": ["r0.6.1", "v1.1", "v1.6"]})
+
+    async def login(self, request):
+        return web.json_response(
+            {"user_id": BOT_USER, "access_token": "bench-token", "device_id": "BENCHDEVICE"}
+        )
+
+    async def whoami(self, request):
+        return web.json_response({"user_id": BOT_USER, "device_id": "BENCHDEVICE"})
+
+    async def upload_filter(self, request):
+        return web.json_response({"filter_id": "1"})
+
+    async def sync(self, request):
+        since = request.query.get("since")
+        timeout = int(request.query.get("timeout", 0)) / 1000
+        if since is None:
+            return web.json_response(self._sync_body(0, full_state=True))
+
+        since = int(since)
+        try:
+            async with self.new_events:
+                await asyncio.wait_for(
+                    self.new_events.wait_for(lambda: self.position > since), timeout
+                )
+        except asyncio.TimeoutError:
+            pass
+        return web.json_response(self._sync_body(since, full_state=False))
+
+    def _sync_body(self, since: int, full_state: bool) -> dict:
+        join = {}
+        for room in self.rooms.values():
+            events = [event for pos, event in room.timeline if pos > since]
+            if not (events or full_state):
+                continue
+            join[room.room_id] = {
+                "state": {"events": room.state if full_state else []},
+                "timeline": {"events": events[-20:], "limited": False, "prev_batch": str(since)},
+                "ephemeral": {"events": []},
+                "account_data": {"events": []},
+                "summary": {"m.joined_member_count": 2, "m.invited_member_count": 0},
+                "unread_notifications": {},
+            }
+        return {
+            "next_batch": str(self.position),
+            "rooms": {"join": join, "invite": {}, "leave": {}},
+            "to_device": {"events": []},
+            "presence": {"events": []},
+            "account_data": {"events": []},
+            "device_lists": {"changed": [], "left": []},
+            "device_one_time_keys_count": {},
+        }
+
+    async def room_send(self, request):
+        room = self.rooms[request.match_info["room_id"]]
+        content = await request.json()
+        event = self._event(BOT_USER, content)
+        await self._append(room, event)
+        if room.pending:
+            sent_at, future = room.pending.popleft()
+            if not future.done():
+                future.set_result((time.perf_counter() - sent_at, content.get("msgtype")))
+        return web.json_response({"event_id": event["event_id"]})
+
+    async def room_messages(self, request):
+        room = self.rooms[request.match_info["room_id"]]
+        limit = int(request.query.get("limit", 10))
+        chunk = [event for _, event in reversed(room.timeline)][:limit]
+        return web.json_response({"chunk": chunk, "start": str(self.position), "end": "0"})
+
+    async def room_get_event(self, request):
+        room = self.rooms[request.match_info["room_id"]]
+        for _, event in room.timeline:
+            if event["event_id"] == request.match_info["event_id"]:
+                return web.json_response(event)
+        return web.json_response({"errcode": "M_NOT_FOUND", "error": "Event not found"}, status=404)
+
+    async def ok(self, request):
+        return web.json_response({})
+
+    async def unexpected_route(self, request):
+        key = f"{request.method} {request.match_info['path']}"
+        self.unexpected[key] = self.unexpected.get(key, 0) + 1
+        return web.json_response({})
+
+    # Load driver API
+
+    async def bench_message(self, request):
+        """Post a message as a user, and wait for the bot reply"""
+        body = await request.json()
+        room = self.rooms[room_id(body["user"])]
+        future = asyncio.get_running_loop().create_future()
+        room.pending.append((time.perf_counter(), future))
+        content = {"msgtype": "m.text", "body": body["text"]}
+        await self._append(room, self._event(room.user, content))
+        try:
+            latency, msgtype = await asyncio.wait_for(future, body.get("timeout", 120))
+        except asyncio.TimeoutError:
+            return web.json_response({"latency": None, "msgtype": None})
+        return web.json_response({"latency": latency, "msgtype": msgtype})
+
+    async def bench_stats(self, request):
+        return web.json_response({"unexpected_routes": self.unexpected})
+
+    def routes(self) -> list:
+        prefix = "/_matrix/client/{version}"
+        return [
+            web.get("/_matrix/client/versions", self.versions),
+            web.post(prefix + "/login", self.login),
+            web.get(prefix + "/account/whoami", self.whoami),
+            web.post(prefix + "/user/{user_id}/filter", self.upload_filter),
+            web.get(prefix + "/sync", self.sync),
+            web.put(prefix + "/rooms/{room_id}/send/{event_type}/{txn_id}", self.room_send),
+            web.put(prefix + "/rooms/{room_id}/typing/{user_id}", self.ok),
+            web.get(prefix + "/rooms/{room_id}/messages", self.room_messages),
+            web.get(prefix + "/rooms/{room_id}/event/{event_id}", self.room_get_event),
+            web.post("/_bench/message", self.bench_message),
+            web.get("/_bench/stats", self.bench_stats),
+            web.route("*", "/{path:.*}", self.unexpected_route),
+        ]
+
+
+class FakeAlbert:
+    def __init__(self, settings: FakeSettings):
+        self.settings = settings
+
+    async def models(self, request):
+        return web.json_response(
+            {"object": "list", "data": [{"id": "bench-model", "type": "text-generation"}]}
+        )
+
+    async def collections(self, request):
+        return web.json_response({"object": "list", "data": []})
+
+    async def search(self, request):
+        await asyncio.sleep(self.settings.search_latency)
+        chunks = [
+            {
+                "score": 0.9 - i / 10,
+                "chunk": {
+                    "id": f"chunk-{i}",
+                    "content": "Contenu de référence " * 40,
+                    "metadata": {"document_name": f"document-{i}.pdf"},
+                },
+            }
+            for i in range(7)
+        ]
+        return web.json_response({"object": "list", "data": chunks})
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        s = self.settings
+        await asyncio.sleep(max(0.0, random.gauss(s.albert_latency, s.albert_jitter)))
+        if random.random() < s.albert_error_rate:
+            return web.json_response({"detail": "Simulated error"}, status=500)
+
+        words = [f"mot{i}" for i in range(s.answer_words)]
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    "id": "chatcmpl-bench",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": " ".join(words)},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in words:
+            chunk = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(s.stream_chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def routes(self) -> list:
+        return [
+            web.get("/v1/models", self.models),
+            web.get("/v1/collections", self.collections),
+            web.post("/v1/search", self.search),
+            web.post("/v1/chat/completions", self.chat_completions),
+        ]
+
+
+class FakeGrist:
+    def __init__(self, settings: FakeSettings):
+        self.settings = settings
+        self.next_id = itertools.count(settings.n_users + 1)
+
+    async def records(self, request):
+        await asyncio.sleep(self.settings.grist_latency)
+        if request.method == "GET":
+            status = json.loads(request.query.get("filter", "{}")).get("status", [])
+            if "allowed" not in status:
+                return web.json_response({"records": []})
+            records = [
+                {
+                    "id": i + 1,
+                    "fields": {
+                        "tchap_user": user_id(i),
+                        "status": "allowed",
+                        "domain": "bench.gouv.fr",
+                        "n_questions": 0,
+                    },
+                }
+                for i in range(self.settings.n_users)
+            ]
+            return web.json_response({"records": records})
+        if request.method == "POST":
+            body = await request.json()
+            records = [{"id": next(self.next_id)} for _ in body["records"]]
+            return web.json_response({"records": records})
+        return web.json_response({})
+
+    def routes(self) -> list:
+        return [web.route("*", "/api/docs/{doc_id}/tables/{table_id}/records", self.records)]
+
+
+def run_fake_servers(settings: FakeSettings, ports: dict, ready) -> None:
+    """Process entry point: serve the three stand-ins until the process is terminated"""
+
+    async def serve():
+        for name, fake in (
+            ("matrix", FakeHomeserver(settings)),
+            ("albert", FakeAlbert(settings)),
+            ("grist", FakeGrist(settings)),
+        ):
+            app = web.Application(client_max_size=10 * 1024 * 1024)
+            app.add_routes(fake.routes())
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", ports[name]).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
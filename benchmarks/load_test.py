@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Offline load test of the bot: the real MatrixBot, Callbacks and commands run against the
+stand-ins of benchmarks/fake_servers.py, with encryption disabled.
+
+For each number of concurrent users, every user sends `--messages` questions in its direct
+room, one after the other, each one once the previous answer has arrived. The report gives
+the throughput (answers/s), the reply latency percentiles (from the user message reaching
+the homeserver to the bot answer reaching it) and the memory of the bot process.
+
+Usage: python benchmarks/load_test.py --users 10 100 1000 --messages 3 --albert-latency 0.5
+"""
+
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+import aiohttp
+from fake_servers import BOT_USER, FakeSettings, run_fake_servers
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../app"))
+
+
+def configure_env(ports: dict, store_dir: str) -> None:
+    """The bot reads its settings from the environment when its modules are imported"""
+    os.environ.update(
+        {
+            "MATRIX_HOME_SERVER": f"http://127.0.0.1:{ports['matrix']}",
+            "MATRIX_BOT_USERNAME": BOT_USER,
+            "MATRIX_BOT_PASSWORD": "bench",
+            "ALBERT_API_URL": f"http://127.0.0.1:{ports['albert']}",
+            "ALBERT_API_TOKEN": "bench",
+            "ALBERT_MODEL": "bench-model",
+            "GRIST_API_SERVER": f"http://127.0.0.1:{ports['grist']}",
+            "GRIST_USERS_TABLE_ID": "bench",
+            "GRIST_USERS_TABLE_NAME": "users",
+            "GROUPS_USED": '["basic", "albert"]',
+            "USER_ALLOWED_DOMAINS": '["*"]',
+            "SYSTEMD_LOGGING": "false",
+            "ENCRYPTION_ENABLED": "false",
+            "STORE_PATH": os.path.join(store_dir, "store"),
+            "SESSION_PATH": os.path.join(store_dir, "session.txt"),
+            "SOURCES_PATH": os.path.join(store_dir, "sources.sqlite"),
+            "DOCUMENTS_INDEX_PATH": os.path.join(store_dir, "documents.sqlite"),
+            "CONVERSATION_OBSOLESCENCE": str(24 * 3600),
+            "LOG_LEVEL": "30",
+        }
+    )
+
+
+def rss_mb() -> float:
+    """Current resident memory of this process"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def simulate_user(session, url: str, user: int, n_messages: int, timeout: float) -> list:
+    results = []
+    for i in range(n_messages):
+        text = f"Question {i} de l'utilisateur {user} ?"
+        payload = {"user": user, "text": text, "timeout": timeout}
+        async with session.post(f"{url}/_bench/message", json=payload) as response:
+            results.append(await response.json())
+    return results
+
+
+async def run_level(url: str, n_users: int, n_messages: int, timeout: float) -> dict:
+    connector = aiohttp.TCPConnector(limit=0)
+    client_timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        start = time.perf_counter()
+        per_user = await asyncio.gather(
+            *(simulate_user(session, url, user, n_messages, timeout) for user in range(n_users))
+        )
+        elapsed = time.perf_counter() - start
+
+    results = [r for user_results in per_user for r in user_results]
+    latencies = sorted(r["latency"] for r in results if r["msgtype"] == "m.text")
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "users": n_users,
+        "answers": len(latencies),
+        "notices": sum(r["msgtype"] == "m.notice" for r in results),
+        "timeouts": sum(r["latency"] is None for r in results),
+        "throughput": len(latencies) / elapsed,
+        "p50": percentiles[49] if percentiles else None,
+        "p95": percentiles[94] if percentiles else None,
+        "p99": percentiles[98] if percentiles else None,
+        "rss_mb": rss_mb(),
+    }
+
+
+def print_report(rows: list[dict]) -> None:
+    header = ["users", "answers", "notices", "timeouts", "answers/s", "p50 (s)", "p95 (s)"]
+    header += ["p99 (s)", "RSS (MB)"]
+    print("".join(f"{h:>11}" for h in header))
+    for r in rows:
+        values = [r["users"], r["answers"], r["notices"], r["timeouts"]]
+        values += [f"{r['throughput']:.2f}"]
+        values += [f"{r[p]:.3f}" if r[p] is not None else "-" for p in ("p50", "p95", "p99")]
+        values += [f"{r['rss_mb']:.0f}"]
+        print("".join(f"{v:>11}" for v in values))
+
+
+def build_bot():
+    # Imported once the environment is set, and out of the event loop: the app modules read
+    # their settings at import time, and commands.py fetches the users table with asyncio.run.
+    sys.path.append(APP_DIR)
+    from matrix_bot.bot import MatrixBot
+    from matrix_bot.config import bot_lib_config
+
+    from bot import register_features
+
+    bot = MatrixBot(
+        os.environ["MATRIX_HOME_SERVER"],
+        os.environ["MATRIX_BOT_USERNAME"],
+        os.environ["MATRIX_BOT_PASSWORD"],
+    )
+    register_features(bot.callbacks)
+    if bot_lib_config.shard_workers:
+        bot.use_shard_workers("bot:register_features")
+    return bot
+
+
+async def main(args, bot):
+    bot_task = asyncio.create_task(bot.main())
+    url = os.environ["MATRIX_HOME_SERVER"]
+    while bot.matrix_client.next_batch is None or not bot.matrix_client.event_callbacks:
+        if bot_task.done():
+            bot_task.result()
+        await asyncio.sleep(0.1)
+    print(f"Bot started, RSS {rss_mb():.0f} MB")
+
+    rows = []
+    for n_users in args.users:
+        rows.append(await run_level(url, n_users, args.messages, args.timeout))
+        print_report(rows[-1:])
+
+    print()
+    print_report(rows)
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{url}/_bench/stats") as response:
+            stats = await response.json()
+    if stats["unexpected_routes"]:
+        print("Requests not handled by the fake homeserver:", stats["unexpected_routes"])
+
+    bot_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await bot_task
+    if bot.dispatcher:
+        bot.dispatcher.stop()
+    await bot.matrix_client.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=3, help="Questions per user")
+    parser.add_argument("--timeout", type=float, default=120, help="Max wait of an answer (s)")
+    parser.add_argument("--albert-latency", type=float, default=0.5, help="Mean (s)")
+    parser.add_argument("--albert-jitter", type=float, default=0.2, help="Std deviation (s)")
+    parser.add_argument("--albert-error-rate", type=float, default=0.0)
+    parser.add_argument("--search-latency", type=float, default=0.05)
+    parser.add_argument("--grist-latency", type=float, default=0.02)
+    parser.add_argument("--answer-words", type=int, default=150)
+    parser.add_argument("--base-port", type=int, default=18000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    settings = FakeSettings(
+        n_users=max(args.users),
+        albert_latency=args.albert_latency,
+        albert_jitter=args.albert_jitter,
+        albert_error_rate=args.albert_error_rate,
+        search_latency=args.search_latency,
+        grist_latency=args.grist_latency,
+        answer_words=args.answer_words,
+    )
+    ports = {"matrix": args.base_port, "albert": args.base_port + 1, "grist": args.base_port + 2}
+
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    fakes = context.Process(target=run_fake_servers, args=(settings, ports, ready), daemon=True)
+    fakes.start()
+    if not ready.wait(30):
+        raise RuntimeError("The fake servers did not start")
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        configure_env(ports, store_dir)
+        try:
+            asyncio.run(main(args, build_bot()))
+        finally:
+            fakes.terminate()
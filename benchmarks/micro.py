@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# SPDX-FileCopyrightText: 2024 Etalab <etalab@modernisation.gouv.fr>
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Micro-benchmarks of the pure python helpers run on every message.
+
+Each benchmark is timed with timeit (best of `--repeat` runs, in µs per call) and compared
+to the stored baselines: the script exits with status 1 if one of them is slower than its
+baseline by more than `--threshold` percent. The comparison is made on the cost relative to
+a calibration loop timed alternately with the benchmark (median of the runs), so that a slower
+or busier machine doesn't show up as a regression.
+
+Usage:
+    python benchmarks/micro.py --save-baseline   # record the baselines of this machine
+    python benchmarks/micro.py                   # compare to them
+    python benchmarks/micro.py -k template sse   # only the benchmarks matching a pattern
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import timeit
+from pathlib import Path
+
+from fake_servers import FakeSettings, run_fake_servers
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../app"))
+BASELINE_FILE = Path(__file__).with_name("micro_baselines.json")
+
+
+def import_app():
+    # commands.py fetches the users table from Grist at import time: serve it a stand-in.
+    ports = {"matrix": 18100, "albert": 18101, "grist": 18102}
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    fakes = context.Process(
+        target=run_fake_servers, args=(FakeSettings(n_users=10), ports, ready), daemon=True
+    )
+    fakes.start()
+    ready.wait(30)
+    os.environ.update(
+        {
+            "GRIST_API_SERVER": f"http://127.0.0.1:{ports['grist']}",
+            "GRIST_USERS_TABLE_ID": "bench",
+            "GRIST_USERS_TABLE_NAME": "users",
+            "GROUPS_USED": '["basic", "albert"]',
+            "SYSTEMD_LOGGING": "false",
+            "LOG_LEVEL": "30",
+        }
+    )
+    sys.path.append(APP_DIR)
+    try:
+        importlib.import_module("commands")
+    finally:
+        fakes.terminate()
+
+
+def build_benchmarks() -> dict:
+    """name -> zero-argument callable, on realistic fixtures"""
+    from matrix_bot.client import extract_text_from_html, render_markdown
+    from nio import Event
+
+    import core_llm
+    import tchap_utils
+    from commands import command_registry
+    from config import env_config
+    from iam import TchapIam
+    from rerank import rerank
+    from utils import sse_decode_chunk
+
+    for group in env_config.groups_used:
+        command_registry.activate_and_retrieve_group(group)
+
+    def message(body: str, relates_to: dict | None = None) -> Event:
+        content = {"msgtype": "m.text", "body": body}
+        if relates_to:
+            content["m.relates_to"] = relates_to
+        return Event.parse_event(
+            {
+                "type": "m.room.message",
+                "event_id": "$event",
+                "sender": "@jean.quidam-ministere_example.gouv.fr:agent.tchap.gouv.fr",
+                "origin_server_ts": 1,
+                "content": content,
+            }
+        )
+
+    question = "Quelles sont les démarches pour renouveler un passeport à l'étranger ?"
+    plain = message(question)
+    reply = message(
+        "> <@albert:agent.tchap.gouv.fr> Voici les étapes à suivre pour le renouvellement\n"
+        "> d'un passeport depuis un consulat, avec les pièces justificatives demandées.\n\n"
+        + question,
+        {"m.in_reply_to": {"event_id": "$previous"}},
+    )
+    answer = "\n".join(
+        f"## Étape {i}\n\n- **Pièce** {i} : justificatif de domicile, voir `service-public.fr`\n"
+        for i in range(30)
+    )
+    answer_html = render_markdown(answer)
+    sse_chunk = "".join(
+        "data: "
+        + json.dumps({"choices": [{"index": 0, "delta": {"content": f"mot{i} "}}]})
+        + "\n\n"
+        for i in range(20)
+    ).encode()
+    chunks = [
+        {
+            "id": f"chunk-{i}",
+            "content": "Le passeport peut être renouvelé auprès du consulat. " * 20,
+            "metadata": {"document_name": f"fiche-{i}.pdf"},
+        }
+        for i in range(7)
+    ]
+    candidates = [
+        {**chunk, "id": f"candidate-{i}", "score": 0.9 - i / 30}
+        for i, chunk in enumerate(chunks * 3)
+    ]
+    albert_client = core_llm.AlbertApiClient(base_url="http://localhost/v1", api_key="-")
+    sender = "@jean.quidam-ministere_example.gouv.fr:agent.ministere_example.tchap.gouv.fr"
+
+    return {
+        "get_cleanup_body/plain": lambda: tchap_utils.get_cleanup_body(plain),
+        "get_cleanup_body/reply": lambda: tchap_utils.get_cleanup_body(reply),
+        "has_keys_along/missing": lambda: tchap_utils.has_keys_along(
+            plain.source, ["content", "m.relates_to", "m.in_reply_to", "event_id"]
+        ),
+        "isa_reply_to/reply": lambda: tchap_utils.isa_reply_to(reply),
+        "domain_from_sender": lambda: TchapIam.domain_from_sender(sender),
+        "extract_text_from_html": lambda: extract_text_from_html(answer_html),
+        "sse_decode_chunk": lambda: sse_decode_chunk(sse_chunk),
+        "format_albert_template": lambda: albert_client.format_albert_template(question, chunks),
+        "rerank/21_candidates": lambda: rerank(question, candidates, 7),
+        "is_valid_command/valid": lambda: command_registry.is_valid_command("reset"),
+        "is_valid_command/invalid": lambda: command_registry.is_valid_command("unknown"),
+    }
+
+
+def calibration():
+    """Reference pure python workload"""
+    total = 0
+    for i in range(1000):
+        total += len(str(i))
+    return total
+
+
+def measure(func, repeat: int) -> tuple[float, float]:
+    """Best time in µs per call, and median cost relative to the calibration loop"""
+    timer, reference = timeit.Timer(func), timeit.Timer(calibration)
+    number, _ = timer.autorange()
+    ref_number, _ = reference.autorange()
+    times, ratios = [], []
+    for _ in range(repeat):
+        ref_time = reference.timeit(ref_number) / ref_number
+        times.append(timer.timeit(number) / number)
+        ratios.append(times[-1] / ref_time)
+    return min(times) * 1e6, statistics.median(ratios)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-k", nargs="*", default=[], help="Only run the matching benchmarks")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--threshold", type=float, default=30, help="Allowed slowdown, in %%")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    import_app()
+    benchmarks = {
+        name: func
+        for name, func in build_benchmarks().items()
+        if not args.k or any(pattern in name for pattern in args.k)
+    }
+    baselines = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+
+    regressions = []
+    results = {}
+    print(f"{'benchmark':<28}{'µs/call':>12}{'relative':>12}{'baseline':>12}{'change':>10}")
+    for name, func in benchmarks.items():
+        duration, results[name] = measure(func, args.repeat)
+        line = f"{name:<28}{duration:>12.2f}{results[name]:>12.4f}"
+        baseline = baselines.get(name)
+        if baseline:
+            change = (results[name] / baseline - 1) * 100
+            flag = " !" if change > args.threshold else ""
+            if flag:
+                regressions.append(name)
+            print(f"{line}{baseline:>12.4f}{change:>+9.1f}%{flag}")
+        else:
+            print(f"{line}{'-':>12}{'-':>10}")
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps({**baselines, **results}, indent=2) + "\n")
+        print(f"Baselines saved to {args.baseline}")
+    elif regressions:
+        print(f"Slower than the baseline by more than {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Compare the sync payload size and processing time of the bot account:
+- the former mode: full_state on every sync, no filter,
+- the filtered mode: lazy-loaded members and event types filter, full_state on the first sync only.
+
+Note: the client used here has no encryption store, so the decryption time is not included.
+"""
+
+import asyncio
+import os
+import sys
+import time
+from collections import namedtuple
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../app")))
+
+from matrix_bot.client import build_sync_filter
+from matrix_bot.config import bot_lib_config
+from nio import AsyncClient, SyncResponse
+
+# Matrix Config
+config = {
+    "server": os.getenv("MATRIX_HOME_SERVER"),
+    "username": os.getenv("MATRIX_BOT_USERNAME"),
+    "password": os.getenv("MATRIX_BOT_PASSWORD"),
+}
+Config = namedtuple("Config", config.keys())
+config = Config(**config)
+
+
+class MeasuredClient(AsyncClient):
+    processing_time = 0.0
+
+    async def receive_response(self, response):
+        start = time.perf_counter()
+        await super().receive_response(response)
+        if isinstance(response, SyncResponse):
+            self.processing_time = time.perf_counter() - start
+
+
+async def measure(client: MeasuredClient, since: str | None, **sync_kwargs) -> dict:
+    client.next_batch = since
+    client.rooms.clear()
+    start = time.perf_counter()
+    response = await client.sync(timeout=0, since=since, **sync_kwargs)
+    total_time = time.perf_counter() - start
+    if not isinstance(response, SyncResponse):
+        raise ValueError(f"Failed to sync: {response}")
+    body = await response.transport_response.read()
+    n_events = sum(
+        len(room.timeline.events) + len(room.state) for room in response.rooms.join.values()
+    )
+    return {
+        "bytes": len(body),
+        "events": n_events,
+        "total_s": total_time,
+        "processing_s": client.processing_time,
+        "next_batch": response.next_batch,
+    }
+
+
+async def main(config: Config):
+    client = MeasuredClient(config.server, config.username)
+    await client.login(config.password)
+
+    sync_filter = build_sync_filter(
+        bot_lib_config.sync_timeline_types, bot_lib_config.sync_timeline_limit
+    )
+    unfiltered = await measure(client, None, full_state=True)
+    token = unfiltered["next_batch"]
+    results = {
+        "initial / unfiltered": unfiltered,
+        "initial / filtered": await measure(client, None, full_state=True, sync_filter=sync_filter),
+        "incremental / full_state": await measure(client, token, full_state=True),
+        "incremental / filtered": await measure(client, token, sync_filter=sync_filter),
+    }
+
+    print(f"{'mode':<28}{'bytes':>12}{'events':>10}{'total (s)':>12}{'processing (s)':>16}")
+    for mode, r in results.items():
+        print(
+            f"{mode:<28}{r['bytes']:>12}{r['events']:>10}"
+            f"{r['total_s']:>12.3f}{r['processing_s']:>16.3f}"
+        )
+
+    await client.close()
+
+
+asyncio.get_event_loop().run_until_complete(main(config))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Flood the CPU executor with attachment decryptions and long markdown answers,
+and measure the event loop lag with each executor kind ("none" is the former behaviour).
+
+Usage: python scripts/loop_lag_check.py [n_attachments] [attachment_mb] [n_answers]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../app")))
+
+from matrix_bot.client import render_markdown
+from matrix_bot.executor import CpuExecutor
+from nio.crypto.attachments import decrypt_attachment, encrypt_attachment
+
+LONG_ANSWER = "\n".join(
+    f"## Section {i}\n\n- **point** {i} with `code` and a [link](https://example.org/{i})\n\n"
+    "```python\nprint('hello')\n```\n"
+    for i in range(300)
+)
+
+
+async def flood(kind: str, n_attachments: int, attachment_mb: int, n_answers: int) -> dict:
+    executor = CpuExecutor(kind)
+    ciphertext, keys = encrypt_attachment(os.urandom(attachment_mb * 1024 * 1024))
+    max_lag = 0.0
+
+    async def probe():
+        nonlocal max_lag
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            delay = time.perf_counter() - start - 0.01
+            max_lag = max(max_lag, delay)
+
+    probe_task = asyncio.create_task(probe())
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            executor.run(
+                decrypt_attachment,
+                ciphertext,
+                keys["key"]["k"],
+                keys["hashes"]["sha256"],
+                keys["iv"],
+            )
+            for _ in range(n_attachments)
+        ),
+        *(executor.run(render_markdown, LONG_ANSWER) for _ in range(n_answers)),
+    )
+    total = time.perf_counter() - start
+    await asyncio.sleep(0.05)  # let the probe see the lag of the last blocking step
+    probe_task.cancel()
+    executor.shutdown()
+    return {"total_s": total, "max_lag_s": max_lag}
+
+
+async def main(n_attachments: int, attachment_mb: int, n_answers: int):
+    print(f"{'executor':<10}{'total (s)':>12}{'max lag (s)':>14}")
+    for kind in ("none", "thread", "process"):
+        r = await flood(kind, n_attachments, attachment_mb, n_answers)
+        print(f"{kind:<10}{r['total_s']:>12.3f}{r['max_lag_s']:>14.3f}")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]] + [20, 5, 50][len(sys.argv) - 1 :]
+    asyncio.get_event_loop().run_until_complete(main(*args))